@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# Load and latency benchmark of broadlink-mqtt using simulated devices and in-process MQTT broker stand-in
+#
+# Usage:
+#   python bench.py [--devices N] [--latency MS] [--jitter MS] [--failures RATE] [--runtime asyncio] [SCENARIO ...]
+# Scenarios: flood, macro, polling, learning (all by default)
+
+import os
+import time
+import random
+import logging
+import asyncio
+import argparse
+import tempfile
+import threading
+import collections
+
+import paho.mqtt.client as paho  # pip install paho-mqtt
+import broadlink  # pip install broadlink
+from test import TestDevice
+
+bench_dir = tempfile.mkdtemp(prefix='broadlink-bench-')
+with open(os.path.join(bench_dir, 'bench.conf'), 'w') as conf:
+    conf.write("device_type = 'test'\n"
+               "mqtt_username = ''\n"
+               "mqtt_password = ''\n"
+               "mqtt_topic_prefix = 'broadlink/'\n"
+               "command_store = %r\n" % os.path.join(bench_dir, 'commands.db'))
+os.environ['BROADLINKMQTTCONFIG'] = os.path.join(bench_dir, 'bench.conf')
+os.environ['BROADLINKMQTTCONFIGCUSTOM'] = os.path.join(bench_dir, 'custom.conf')
+
+import mqtt  # noqa: E402
+import codestore  # noqa: E402
+
+
+class SimulatedDevice(TestDevice):
+    """Test device answering with UDP-like latency and failing with given probability"""
+
+    def __init__(self, cf, number, device_type, latency, jitter, failure_rate):
+        TestDevice.__init__(self, cf)
+        self.type = device_type
+        self.host = ('10.0.0.%d' % (number + 1), 80)
+        self.mac = bytearray([0x02, 0, 0, 0, number // 256, number % 256])
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.sent = collections.deque()  # completion times of send_data calls
+        self.learned_at = None
+
+    def round_trip(self):
+        time.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        if random.random() < self.failure_rate:
+            raise broadlink.exceptions.NetworkTimeoutError(-4000, "Network timeout", "simulated failure")
+
+    def auth(self):
+        self.round_trip()
+
+    def send_data(self, data):
+        self.round_trip()
+        self.sent.append(time.monotonic())
+
+    def check_temperature(self):
+        self.round_trip()
+        return round(random.uniform(20, 25), 1)
+
+    def check_humidity(self):
+        self.round_trip()
+        return random.randint(30, 60)
+
+    def get_energy(self):
+        self.round_trip()
+        return round(random.uniform(0, 100), 1)
+
+    def check_power(self):
+        self.round_trip()
+        return TestDevice.check_power(self)
+
+    def set_power(self, *args):
+        self.round_trip()
+
+    def enter_learning(self):
+        self.round_trip()
+        # simulated user presses the button a bit later
+        self.learned_at = time.monotonic() + 0.5
+
+    def check_data(self):
+        self.round_trip()
+        if self.learned_at is None or time.monotonic() < self.learned_at:
+            raise broadlink.exceptions.ReadError(-5, "Read error", "no data")
+        return TestDevice.check_data(self)
+
+
+class BrokerStub(object):
+    """In-process MQTT broker stand-in delivering messages to the bridge from a single network thread like paho does"""
+
+    def __init__(self, router):
+        self.router = router
+        self.subscriptions = []
+        self.published = 0
+        self.inbox = collections.deque()
+        self.condition = threading.Condition()
+        thread = threading.Thread(target=self.loop)
+        thread.daemon = True
+        thread.start()
+
+    def is_connected(self):
+        return True
+
+    # noinspection PyUnusedLocal
+    def subscribe(self, topic, qos=0, options=None):
+        self.subscriptions.append(topic)
+        return 0, 1
+
+    def unsubscribe(self, topic):
+        if topic in self.subscriptions:
+            self.subscriptions.remove(topic)
+        return 0, 1
+
+    # noinspection PyUnusedLocal
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published += 1
+
+    def send(self, topic, payload):
+        """Message published by another client"""
+        if not any(paho.topic_matches_sub(sub, topic) for sub in self.subscriptions):
+            return
+        with self.condition:
+            self.inbox.append(paho.MQTTMessage(topic=topic.encode('utf-8')))
+            self.inbox[-1].payload = payload.encode('utf-8')
+            self.condition.notify()
+
+    def loop(self):
+        while True:
+            with self.condition:
+                while not self.inbox:
+                    self.condition.wait()
+                msg = self.inbox.popleft()
+            mqtt.on_message(self, self.router, msg)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Bench(object):
+    def __init__(self, args):
+        self.args = args
+        self.devices = {}
+        self.router = None
+        self.broker = None
+
+    def start(self, count, device_type):
+        devices = {}
+        for number in range(count):
+            device = SimulatedDevice(mqtt.cf, number, device_type,
+                                     self.args.latency / 1000.0, self.args.jitter / 1000.0, self.args.failures)
+            subprefix = 'SIM_%03d/' % number
+            device.auth()
+            devices[subprefix] = mqtt.configure_device(device, mqtt.settings.topic_prefix + subprefix)
+        self.devices = devices
+        self.router = mqtt.TopicRouter(devices)
+        self.broker = BrokerStub(self.router)
+        mqtt.mqttc = self.broker
+        mqtt.on_connect(self.broker, self.router, {}, 0)
+
+    def stop(self):
+        for device in self.devices.values():
+            mqtt.scheduler.remove(device)
+            device.worker.stop()
+
+    def wait_sent(self, expected, timeout):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if sum(len(device.sent) for device in self.devices.values()) >= expected:
+                return True
+            time.sleep(0.01)
+        return False
+
+    def command_latencies(self, published):
+        """Latencies between publishing of commands and sending of their last packet to the device"""
+        latencies = []
+        for subprefix, times in published.items():
+            sent = list(self.devices[subprefix].sent)
+            latencies.extend(done - start for start, done in zip(times, sent))
+        return latencies
+
+    def report(self, name, messages, elapsed, latencies, extra=None):
+        result = collections.OrderedDict()
+        result['scenario'] = name
+        result['messages/s'] = round(messages / elapsed, 1) if elapsed > 0 else 0
+        result['p50 ms'] = round(percentile(latencies, 0.5) * 1000, 1)
+        result['p99 ms'] = round(percentile(latencies, 0.99) * 1000, 1)
+        if extra:
+            result.update(extra)
+        result['threads'] = threading.active_count()
+        result['rss MB'] = round(rss() / 1048576.0, 1)
+        print('  '.join('%s=%s' % item for item in result.items()))
+        return result
+
+    def flood(self):
+        """Every device receives a stream of replay commands"""
+        count = self.args.commands
+        self.start(self.args.devices, 'RM4')
+        published = collections.defaultdict(list)
+        start = time.monotonic()
+        for i in range(count):
+            for subprefix in self.devices:
+                published[subprefix].append(time.monotonic())
+                self.broker.send(mqtt.settings.topic_prefix + subprefix + 'tv/samsung/volumeup', 'replay')
+        self.wait_sent(count * len(self.devices), 60)
+        elapsed = time.monotonic() - start
+        result = self.report('flood', count * len(self.devices), elapsed, self.command_latencies(published))
+        self.stop()
+        return result
+
+    def macro(self):
+        """Every device receives bursts of macros"""
+        count = max(1, self.args.commands // 10)
+        self.start(self.args.devices, 'RM4')
+        steps = len([step for step in mqtt.macro_cache.get(mqtt.dirname + 'macros/samsung_on') if step[0] == 'send'])
+        published = collections.defaultdict(list)
+        start = time.monotonic()
+        for i in range(count):
+            for subprefix in self.devices:
+                published[subprefix].extend([time.monotonic()] * steps)
+                self.broker.send(mqtt.settings.topic_prefix + subprefix + 'macro', 'samsung_on')
+        self.wait_sent(count * steps * len(self.devices), 120)
+        elapsed = time.monotonic() - start
+        latencies = self.command_latencies(published)[steps - 1::steps]
+        result = self.report('macro', count * len(self.devices), elapsed, latencies)
+        self.stop()
+        return result
+
+    def polling(self):
+        """Many devices polled every second"""
+        mqtt.settings = mqtt.settings._replace(rm_temperature_interval=1)
+        mqtt.metrics.histograms.clear()
+        self.start(self.args.devices, 'RM4')
+        start = time.monotonic()
+        time.sleep(self.args.duration)
+        elapsed = time.monotonic() - start
+        lateness = []
+        polls = 0
+        for (name, labels), histogram in list(mqtt.metrics.histograms.items()):
+            if name == 'broadlink_mqtt_poll_lateness_seconds':
+                polls += histogram[-2]
+                lateness.append(mqtt.metrics.percentile(histogram, 0.99))
+        result = self.report('polling', self.broker.published, elapsed, [],
+                             {'polls': polls, 'p99 lateness ms': round(max(lateness or [0]) * 1000, 1)})
+        mqtt.settings = mqtt.settings._replace(rm_temperature_interval=0)
+        self.stop()
+        return result
+
+    def learning(self):
+        """One device learns a command while others receive a stream of commands"""
+        count = self.args.commands
+        self.start(self.args.devices + 1, 'RM4')
+        learner = sorted(self.devices)[-1]
+        learned = threading.Event()
+        published = collections.defaultdict(list)
+        start = time.monotonic()
+        self.broker.send(mqtt.settings.topic_prefix + learner + 'bench/learned', 'record')
+        for i in range(count):
+            for subprefix in self.devices:
+                if subprefix != learner:
+                    published[subprefix].append(time.monotonic())
+                    self.broker.send(mqtt.settings.topic_prefix + subprefix + 'tv/samsung/volumeup', 'replay')
+        self.wait_sent(count * (len(self.devices) - 1), 60)
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline and not learned.is_set():
+            if mqtt.command_cache.get(mqtt.dirname + 'commands/bench/learned') is not None:
+                learned.set()
+            time.sleep(0.01)
+        elapsed = time.monotonic() - start
+        result = self.report('learning', count * (len(self.devices) - 1), elapsed, self.command_latencies(published),
+                             {'learned s': round(elapsed, 2) if learned.is_set() else 'timeout'})
+        self.stop()
+        return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load and latency benchmark of broadlink-mqtt')
+    parser.add_argument('scenarios', nargs='*', default=['flood', 'macro', 'polling', 'learning'])
+    parser.add_argument('--devices', type=int, default=20, help='number of simulated devices')
+    parser.add_argument('--commands', type=int, default=50, help='number of commands sent to every device')
+    parser.add_argument('--latency', type=float, default=20, help='mean device round trip in milliseconds')
+    parser.add_argument('--jitter', type=float, default=5, help='standard deviation of device round trip in milliseconds')
+    parser.add_argument('--failures', type=float, default=0, help='probability of device call failure')
+    parser.add_argument('--duration', type=float, default=10, help='duration of polling scenario in seconds')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    parser.add_argument('--runtime', choices=['threads', 'asyncio'], default='threads', help='runtime of the bridge')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    logging.getLogger().setLevel(logging.WARNING)
+    codestore.import_directory(mqtt.command_cache.store, mqtt.dirname + 'commands/')
+
+    mqtt.runtime = args.runtime
+    if args.runtime == 'asyncio':
+        loop = asyncio.new_event_loop()
+        loop_thread = threading.Thread(target=loop.run_forever)
+        loop_thread.daemon = True
+        loop_thread.start()
+
+        async def create_scheduler():
+            return mqtt.AsyncScheduler(loop, False, mqtt.cf.get('asyncio_workers', 8),
+                                       mqtt.cf.get('broadlink_poll_workers', 4), mqtt.cf.get('broadlink_poll_timeout', 10))
+        mqtt.scheduler = asyncio.run_coroutine_threadsafe(create_scheduler(), loop).result()
+        mqtt.publisher.loop = loop
+    else:
+        mqtt.scheduler = mqtt.PollScheduler(False, mqtt.cf.get('broadlink_poll_workers', 4),
+                                            mqtt.cf.get('broadlink_poll_timeout', 10))
+        mqtt.scheduler.start()
+        mqtt.publisher.start()
+
+    bench = Bench(args)
+    for scenario in args.scenarios:
+        getattr(bench, scenario)()
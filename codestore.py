@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# Single file store of recorded IR/RF commands
+#
+# File starts with MAGIC followed by records appended one after another:
+#   key length (2 bytes), data length (4 bytes), key (UTF-8), raw packet data
+# Record written later overrides previous records with the same key.
+# Several processes may share the store: records are appended under an exclusive lock of the file and
+# records appended by other processes are indexed when the file grows.
+#
+# Usage:
+#   python codestore.py import STORE_FILE [COMMANDS_DIR]  - add all commands from folder (default: commands/) to the store
+#   python codestore.py export STORE_FILE [COMMANDS_DIR]  - save all commands from the store to separate files in folder
+
+import os
+import sys
+import mmap
+import struct
+import binascii
+import contextlib
+from threading import Lock
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks, store can't be shared by processes
+    fcntl = None
+
+MAGIC = b'BLCS\x01'
+HEADER = struct.Struct('>HI')
+
+
+class CodeStore(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.index = {}  # key -> (offset, length) of the packet data
+        self.lock = Lock()
+        # append mode, so records of all processes go to the current end of the file
+        self.file = open(filename, 'a+b')
+        with self.locked():
+            if os.fstat(self.file.fileno()).st_size == 0:
+                self.file.write(MAGIC)
+                self.file.flush()
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            if self.map[:len(MAGIC)] != MAGIC:
+                raise IOError("File %s is not a command store" % filename)
+            self.size = self.load(len(MAGIC))
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Exclusive lock of the file shared by all processes using the store"""
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+
+    def load(self, offset):
+        """Indexes records starting from offset and returns size of the file without incomplete last record,
+        called with the file locked"""
+        size = len(self.map)
+        while offset + HEADER.size <= size:
+            key_length, data_length = HEADER.unpack_from(self.map, offset)
+            start = offset + HEADER.size + key_length
+            if start + data_length > size:
+                break
+            key = self.map[offset + HEADER.size:start].decode('utf-8')
+            self.index[key] = (start, data_length)
+            offset = start + data_length
+        if offset < size:
+            # last record was not written completely
+            self.file.truncate(offset)
+        return offset
+
+    def refresh(self):
+        """Indexes records appended by other processes, called with the lock held"""
+        if os.fstat(self.file.fileno()).st_size != self.size:
+            with self.locked():
+                self.load_appended()
+
+    def load_appended(self):
+        if os.fstat(self.file.fileno()).st_size != self.size:
+            self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.size = self.load(self.size)
+
+    def get(self, key):
+        with self.lock:
+            self.refresh()
+            entry = self.index.get(key)
+            if entry is None:
+                return None
+            offset, length = entry
+            return self.map[offset:offset + length]
+
+    def version(self, key):
+        """Returns value changing every time the record is overwritten or None if there is no such record"""
+        with self.lock:
+            self.refresh()
+            entry = self.index.get(key)
+            return entry[0] if entry is not None else None
+
+    def put(self, key, data):
+        encoded_key = key.encode('utf-8')
+        data = bytes(data)
+        # whole record is written at once, incomplete record is dropped on next opening
+        record = HEADER.pack(len(encoded_key), len(data)) + encoded_key + data
+        with self.lock, self.locked():
+            self.load_appended()
+            self.file.write(record)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.index[key] = (self.size + HEADER.size + len(encoded_key), len(data))
+            self.size += len(record)
+
+    def keys(self):
+        with self.lock:
+            self.refresh()
+            return sorted(self.index.keys())
+
+    def close(self):
+        with self.lock:
+            self.map.close()
+            self.file.close()
+
+
+def import_directory(store, directory):
+    count = 0
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            file = os.path.join(root, name)
+            with open(file, 'rb') as f:
+                packet = binascii.unhexlify(f.read().strip())
+            store.put(os.path.relpath(file, directory).replace(os.sep, '/'), packet)
+            count += 1
+    return count
+
+
+def export_directory(store, directory):
+    count = 0
+    for key in store.keys():
+        file = os.path.join(directory, *key.split('/'))
+        if not os.path.exists(os.path.dirname(file)):
+            os.makedirs(os.path.dirname(file))
+        with open(file, 'wb') as f:
+            f.write(binascii.hexlify(store.get(key)))
+        count += 1
+    return count
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 4) or sys.argv[1] not in ('import', 'export'):
+        print("Usage: %s import|export STORE_FILE [COMMANDS_DIR]" % sys.argv[0])
+        sys.exit(2)
+    commands_dir = sys.argv[3] if len(sys.argv) == 4 else \
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'commands')
+    code_store = CodeStore(sys.argv[2])
+    if sys.argv[1] == 'import':
+        print("Imported %d commands" % import_directory(code_store, commands_dir))
+    else:
+        print("Exported %d commands" % export_directory(code_store, commands_dir))
+    code_store.close()
@@ -3,17 +3,33 @@
 import paho.mqtt.client as paho  # pip install paho-mqtt
 import broadlink  # pip install broadlink
 import os
+import errno
 import sys
 import time
 import logging
 import logging.config
 import socket
-import sched
+import stat
+import heapq
+import itertools
+import random
+import asyncio
+import signal
+import shutil
+import subprocess
+import tempfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
 import json
 import binascii
 import types
-from threading import Thread
+import collections
+import contextlib
+from threading import Thread, Condition, Event, Lock, get_ident
 from test import TestDevice
+from codestore import CodeStore
 
 HAVE_TLS = True
 try:
@@ -21,6 +37,12 @@ try:
 except ImportError:
     HAVE_TLS = False
 
+try:
+    import fcntl
+except ImportError:
+    # no file locks, files can't be shared by worker processes
+    fcntl = None
+
 # read initial config files
 dirname = os.path.dirname(os.path.abspath(__file__)) + '/'
 logging.config.fileConfig(dirname + 'logging.conf')
@@ -64,185 +86,952 @@ class Config(object):
         return v
 
 
+class CommandCache(object):
+    """LRU cache of decoded IR/RF packets keyed by command file, validated by file modification time"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = collections.OrderedDict()  # file -> (mtime, packet)
+        self.lock = Lock()
+
+    def get(self, file):
+        try:
+            st = os.stat(file)
+        except OSError:
+            self.invalidate(file)
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        mtime = st.st_mtime
+
+        with self.lock:
+            entry = self.entries.get(file)
+            if entry is not None and entry[0] == mtime:
+                self.entries.move_to_end(file)
+                return entry[1]
+
+        with open(file, 'rb') as f:
+            packet = binascii.unhexlify(f.read().strip())
+        self.put(file, mtime, packet)
+        return packet
+
+    def version(self, file):
+        return file_mtime(file)
+
+    def save(self, file, packet):
+        directory = os.path.dirname(file)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(file, 'wb') as f:
+            f.write(binascii.hexlify(packet))
+        self.put(file, os.stat(file).st_mtime, bytes(packet))
+
+    def put(self, file, mtime, packet):
+        with self.lock:
+            self._remove(file)
+            if len(packet) > self.max_size:
+                return
+            self.entries[file] = (mtime, packet)
+            self.size += len(packet)
+            while self.size > self.max_size:
+                self.size -= len(self.entries.popitem(last=False)[1][1])
+
+    def invalidate(self, file):
+        with self.lock:
+            self._remove(file)
+
+    def _remove(self, file):
+        entry = self.entries.pop(file, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def preload(self, directory):
+        count = 0
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                try:
+                    if self.get(os.path.join(root, name)) is not None:
+                        count += 1
+                except (IOError, ValueError, TypeError):
+                    logging.warning("Cannot preload command file " + os.path.join(root, name))
+        logging.debug("Preloaded %d commands from %s" % (count, directory))
+
+
+class StoredCommands(object):
+    """Recorded commands kept in a single file code store instead of separate files in commands/ folder"""
+
+    def __init__(self, store, directory):
+        self.store = store
+        self.directory = directory
+
+    def key(self, file):
+        return os.path.relpath(file, self.directory).replace(os.sep, '/')
+
+    def get(self, file):
+        return self.store.get(self.key(file))
+
+    def version(self, file):
+        return self.store.version(self.key(file))
+
+    def save(self, file, packet):
+        self.store.put(self.key(file), packet)
+
+    def preload(self, directory):
+        # all commands of the store are always available without reading files
+        pass
+
+
+class MacroCache(object):
+    """Compiled macros keyed by macro file, recompiled when the macro or any command it uses is modified"""
+
+    def __init__(self, commands):
+        self.commands = commands  # CommandCache or StoredCommands
+        self.entries = {}  # file -> (mtime, dependencies, plan)
+        self.lock = Lock()
+
+    def get(self, file):
+        with self.lock:
+            entry = self.entries.get(file)
+        if entry is not None and file_mtime(file) == entry[0] and \
+                all(self.commands.version(f) == version for f, version in entry[1]):
+            return entry[2]
+
+        mtime = file_mtime(file)
+        dependencies, plan = self.compile(file)
+        with self.lock:
+            self.entries[file] = (mtime, dependencies, plan)
+        return plan
+
+    def compile(self, file):
+        """Returns tuple of (command file, version) dependencies and plan as a tuple of ('send', packet) and
+        ('pause', seconds) steps"""
+        dependencies = []
+        plan = []
+        missing = []
+        with open(file, 'r') as f:
+            for line in f:
+                line = line.strip(' \n\r\t')
+                if len(line) == 0 or line.startswith("#"):
+                    continue
+                if line.startswith("pause "):
+                    plan.append(('pause', int(line[6:].strip()) / 1000.0))
+                else:
+                    command_file = dirname + "commands/" + line
+                    version = self.commands.version(command_file)
+                    packet = self.commands.get(command_file)
+                    if packet is None:
+                        missing.append(line)
+                        continue
+                    dependencies.append((command_file, version))
+                    plan.append(('send', packet))
+        if missing:
+            raise IOError(errno.ENOENT, "Macro %s references missing commands" % file, ', '.join(missing))
+        logging.debug("Compiled macro %s to %d steps" % (file, len(plan)))
+        return tuple(dependencies), tuple(plan)
+
+
+class PublishFilter(object):
+    """Remembers last published value of every topic to suppress publishing of unchanged values"""
+
+    def __init__(self, changes_only, deadband, heartbeat):
+        self.changes_only = changes_only
+        self.deadband = deadband  # number or dictionary {last topic level: number}
+        self.heartbeat = heartbeat
+        self.values = {}  # topic -> (value, publish time)
+        self.lock = Lock()
+
+    def accept(self, topic, value, force=False):
+        if not self.changes_only:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            last = self.values.get(topic)
+            if last is not None and not force and (self.heartbeat <= 0 or now - last[1] < self.heartbeat) and \
+                    self.is_same(topic, last[0], value):
+                return False
+            self.values[topic] = (value, now)
+        return True
+
+    def is_same(self, topic, old, new):
+        if old == new:
+            return True
+        deadband = self.deadband.get(topic.rsplit('/', 1)[-1], 0) if isinstance(self.deadband, dict) else self.deadband
+        if deadband <= 0:
+            return False
+        try:
+            return abs(float(new) - float(old)) < deadband
+        except ValueError:
+            return False
+
+
+class ReadCache(object):
+    """Keeps values recently read from devices, concurrent reads of the same value share a single call to the device"""
+
+    def __init__(self):
+        self.values = {}  # (device, method) -> (read time, value)
+        self.reads = {}  # (device, method) -> [event set when finished, value, error] of read in progress
+        self.lock = Lock()
+
+    def read(self, device, method, max_age):
+        key = (device, method)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is not None and time.monotonic() - entry[0] < max_age:
+                metrics.inc('broadlink_mqtt_read_cache_hits_total', read=method)
+                return entry[1]
+            read = self.reads.get(key)
+            if read is None:
+                read = self.reads[key] = [Event(), None, None]
+                leader = True
+            else:
+                leader = False
+        if not leader:
+            metrics.inc('broadlink_mqtt_read_coalesced_total', read=method)
+            read[0].wait()
+            if isinstance(read[2], DeviceSession.ERRORS):
+                # the device is not called again by every waiting request, failed read is retried by its caller only
+                raise DeviceUnavailableError("Reading %s of device %s at %s failed (%s)" %
+                                             (method, device.type, device.host[0], read[2]))
+            if read[2] is not None:
+                raise read[2]
+            return read[1]
+        try:
+            read[1] = getattr(device, method)()
+            with self.lock:
+                self.values[key] = (time.monotonic(), read[1])
+            return read[1]
+        except Exception as e:
+            read[2] = e
+            raise
+        finally:
+            with self.lock:
+                del self.reads[key]
+            read[0].set()
+
+    def forget(self, device):
+        """Drops values of the device, e.g. after a command changing its state"""
+        with self.lock:
+            for key in [key for key in self.values if key[0] is device]:
+                del self.values[key]
+
+
+class Publisher(Thread):
+    """Sends outbound messages from a bounded buffer keeping only the last value of every topic, so values published
+    while MQTT broker is not connected are coalesced and only the latest state is sent after reconnection"""
+
+    def __init__(self, size):
+        Thread.__init__(self)
+        self.daemon = True
+        self.size = size
+        self.pending = collections.OrderedDict()  # topic -> (payload, qos, retain)
+        self.condition = Condition()
+        self.connected = False
+        self.loop = None  # asyncio event loop sending buffered messages instead of the thread
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        with self.condition:
+            if topic in self.pending:
+                metrics.inc('broadlink_mqtt_publish_coalesced_total')
+                del self.pending[topic]
+            elif 0 < self.size <= len(self.pending):
+                self.pending.popitem(last=False)
+                metrics.inc('broadlink_mqtt_publish_dropped_total')
+            self.pending[topic] = (payload, qos, retain)
+            metrics.set('broadlink_mqtt_publish_queue_depth', len(self.pending))
+            self.condition.notify()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.send_pending)
+
+    def set_connected(self, connected):
+        with self.condition:
+            self.connected = connected
+            self.condition.notify()
+        if connected and self.loop is not None:
+            self.loop.call_soon_threadsafe(self.send_pending)
+
+    def take(self):
+        """Returns the oldest buffered message or None if there is nothing to send now"""
+        with self.condition:
+            if not self.connected or not self.pending:
+                return None
+            topic, (payload, qos, retain) = self.pending.popitem(last=False)
+            metrics.set('broadlink_mqtt_publish_queue_depth', len(self.pending))
+            return topic, payload, qos, retain
+
+    def send_pending(self):
+        while True:
+            message = self.take()
+            if message is None:
+                return
+            topic, payload, qos, retain = message
+            try:
+                result = mqttc.publish(topic, payload, qos=qos, retain=retain)
+            except Exception:
+                logging.exception("Error")
+                continue
+            if result is not None and result.rc == paho.MQTT_ERR_NO_CONN:
+                # connection is lost, message is sent after reconnection unless there is a newer value already
+                with self.condition:
+                    self.connected = False
+                    if topic not in self.pending:
+                        self.pending[topic] = (payload, qos, retain)
+                        self.pending.move_to_end(topic, last=False)
+                return
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.connected or not self.pending:
+                    self.condition.wait()
+            self.send_pending()
+
+
+class TopicRouter(object):
+    """Finds device addressed by MQTT topic using index of device sub-prefixes"""
+
+    def __init__(self, devices):
+        self.lock = Lock()
+        self.table = devices.copy() if isinstance(devices, dict) else {'': devices}  # sub-prefix -> device
+        self.index = self.build(self.table)
+
+    @staticmethod
+    def build(table):
+        """Returns tuple of (routes, levels, others) where routes is a dictionary of sub-prefixes ending with '/',
+        levels is a list of distinct numbers of topic levels in them, others is a list of (sub-prefix, device)
+        for sub-prefixes not ending with '/'"""
+        routes = {}
+        levels = []
+        others = []
+        for subprefix, device in table.items():
+            if subprefix == '' or subprefix.endswith('/'):
+                routes[subprefix] = device
+                level = subprefix.count('/')
+                if level not in levels:
+                    levels.append(level)
+            else:
+                others.append((subprefix, device))
+        return routes, levels, others
+
+    def add(self, subprefix, device):
+        with self.lock:
+            self.table[subprefix] = device
+            # index is replaced at once, so topics being resolved at the moment are not affected
+            self.index = self.build(self.table)
+
+    def remove(self, subprefix):
+        with self.lock:
+            del self.table[subprefix]
+            self.index = self.build(self.table)
+
+    def items(self):
+        with self.lock:
+            return list(self.table.items())
+
+    def devices(self):
+        return [device for subprefix, device in self.items()]
+
+    def subprefixes(self):
+        return [subprefix for subprefix, device in self.items()]
+
+    def resolve(self, command):
+        """Returns addressed device and rest of the topic or (None, command) if there is no such device"""
+        routes, levels, others = self.index
+        for level in levels:
+            parts = command.split('/', level)
+            if len(parts) > level:
+                device = routes.get(command[:len(command) - len(parts[-1])])
+                if device is not None:
+                    return device, parts[-1]
+        for subprefix, device in others:
+            if command.startswith(subprefix):
+                return device, command[len(subprefix):]
+        return None, command
+
+
+class Metrics(object):
+    """Counters, gauges and latency histograms exposed as JSON and in Prometheus text format"""
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.counters = {}  # (name, labels) -> value
+        self.gauges = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [count per bucket..., count, sum]
+        self.lock = Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.BUCKETS) + 2)
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+                    break
+            histogram[-2] += 1
+            histogram[-1] += seconds
+
+    @staticmethod
+    def format_labels(labels):
+        return '{' + ','.join('%s="%s"' % (name, value) for name, value in labels) + '}' if labels else ''
+
+    def percentile(self, histogram, fraction):
+        """Returns upper bound of the bucket containing given fraction of observations"""
+        rank = histogram[-2] * fraction
+        total = 0
+        for i, bound in enumerate(self.BUCKETS):
+            total += histogram[i]
+            if total >= rank:
+                return bound
+        return float('inf')
+
+    def summary(self):
+        with self.lock:
+            result = {}
+            for (name, labels), value in list(self.counters.items()) + list(self.gauges.items()):
+                result[name + self.format_labels(labels)] = value
+            for (name, labels), histogram in self.histograms.items():
+                result[name + self.format_labels(labels)] = {
+                    'count': histogram[-2],
+                    'sum': round(histogram[-1], 6),
+                    'p50': self.percentile(histogram, 0.5),
+                    'p99': self.percentile(histogram, 0.99)}
+            return result
+
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append('%s%s %s' % (name, self.format_labels(labels), value))
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append('%s%s %s' % (name, self.format_labels(labels), value))
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                total = 0
+                for i, bound in enumerate(self.BUCKETS):
+                    total += histogram[i]
+                    lines.append('%s_bucket%s %d' % (name, self.format_labels(labels + (('le', bound),)), total))
+                lines.append('%s_bucket%s %d' % (name, self.format_labels(labels + (('le', '+Inf'),)), histogram[-2]))
+                lines.append('%s_count%s %d' % (name, self.format_labels(labels), histogram[-2]))
+                lines.append('%s_sum%s %f' % (name, self.format_labels(labels), histogram[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # noinspection PyShadowingBuiltins
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@contextlib.contextmanager
+def file_lock(filename):
+    """Exclusive lock of a file shared by worker processes, the lock is kept in a separate file, so the file itself
+    can be replaced"""
+    with open(filename + '.lock', 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+class RFFrequencies(object):
+    """RF frequencies found by sweeping, keyed by folder of the learned command (i.e. by remote),
+    the file may be shared by worker processes, so it's read again when it was changed"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.frequencies = {}
+        self.mtime = None
+        self.lock = Lock()
+        self.load()
+
+    def load(self):
+        try:
+            mtime = os.stat(self.filename).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+        try:
+            with open(self.filename, 'r') as f:
+                self.frequencies = json.load(f)
+        except (IOError, ValueError):
+            logging.exception("Cannot read RF frequencies from file " + self.filename)
+
+    def get(self, remote):
+        with self.lock:
+            self.load()
+            return self.frequencies.get(remote)
+
+    def put(self, remote, frequency):
+        self.update(remote, frequency)
+
+    def remove(self, remote):
+        self.update(remote, None)
+
+    def update(self, remote, frequency):
+        """Sets or removes (None) frequency of the remote keeping changes made by other processes"""
+        with self.lock, file_lock(self.filename):
+            self.load()
+            if frequency is not None:
+                self.frequencies[remote] = frequency
+            elif self.frequencies.pop(remote, None) is None:
+                return
+            try:
+                with open(self.filename + '.tmp', 'w') as f:
+                    json.dump(self.frequencies, f, indent=2, sort_keys=True)
+                os.rename(self.filename + '.tmp', self.filename)
+                self.mtime = os.stat(self.filename).st_mtime_ns
+            except (IOError, OSError):
+                logging.exception("Cannot write RF frequencies to file " + self.filename)
+
+
+# settings read by hot paths, they are applied live when configuration is reloaded
+Settings = collections.namedtuple('Settings', [
+    'qos', 'retain', 'topic_prefix', 'command_subprefix', 'reload_topic', 'birth_topic', 'birth_payload',
+    'rm_temperature_interval', 'sp_energy_interval', 'a1_sensors_interval', 'mp1_state_interval',
+    'dooya_position_interval', 'bg1_state_interval',
+    'a1_sensors_text_values', 'a1_sensors_json', 'mp1_state_json', 'bg1_state_json', 'coalesce_window',
+    'read_cache_ttl'])
+
+POLL_SETTINGS = ('rm_temperature_interval', 'sp_energy_interval', 'a1_sensors_interval', 'mp1_state_interval',
+                 'dooya_position_interval', 'bg1_state_interval')
+
+
+def load_settings(config):
+    """Validates configuration once into immutable snapshot of settings"""
+    def number(key, default):
+        value = config.get(key, default)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            raise ValueError("Configuration parameter '%s' should be a non-negative number" % key)
+        return value
+
+    def text(key, default):
+        value = config.get(key, default)
+        if value is not None and not isinstance(value, str):
+            raise ValueError("Configuration parameter '%s' should be a string" % key)
+        return value
+
+    qos = config.get('mqtt_qos', 0)
+    if qos not in (0, 1, 2):
+        raise ValueError("Configuration parameter 'mqtt_qos' should be 0, 1 or 2")
+    return Settings(
+        qos=qos,
+        retain=bool(config.get('mqtt_retain', False)),
+        topic_prefix=text('mqtt_topic_prefix', 'broadlink/'),
+        command_subprefix=text('mqtt_command_subprefix', ''),
+        reload_topic=text('mqtt_reload_topic', None),
+        birth_topic=text('mqtt_birth_topic', 'clients/broadlink'),
+        birth_payload=config.get('mqtt_birth_payload', None) or None,
+        rm_temperature_interval=number('broadlink_rm_temperature_interval', 0),
+        sp_energy_interval=number('broadlink_sp_energy_interval', 0),
+        a1_sensors_interval=number('broadlink_a1_sensors_interval', 0),
+        mp1_state_interval=number('broadlink_mp1_state_interval', 0),
+        dooya_position_interval=number('broadlink_dooya_position_interval', 0),
+        bg1_state_interval=number('broadlink_bg1_state_interval', 0),
+        a1_sensors_text_values=bool(config.get('broadlink_a1_sensors_text_values', False)),
+        a1_sensors_json=bool(config.get('broadlink_a1_sensors_json', False)),
+        mp1_state_json=bool(config.get('broadlink_mp1_state_json', False)),
+        bg1_state_json=bool(config.get('broadlink_bg1_state_json', False)),
+        coalesce_window=number('command_coalesce_window', 0),
+        read_cache_ttl=number('broadlink_read_cache_ttl', 5))
+
+
+def file_mtime(file):
+    try:
+        return os.stat(file).st_mtime
+    except OSError:
+        return None
+
+
 try:
     cf = Config()
+    settings = load_settings(cf)
 except Exception as e:
     print("Cannot load configuration from file %s: %s" % (CONFIG, str(e)))
     sys.exit(2)
 
-qos = cf.get('mqtt_qos', 0)
-retain = cf.get('mqtt_retain', False)
-
-topic_prefix = cf.get('mqtt_topic_prefix', 'broadlink/')
+mqtt_protocol = paho.MQTTv5 if cf.get('mqtt_protocol', 'MQTTv311') == 'MQTTv5' else paho.MQTTv311
+runtime = cf.get('runtime', 'threads')
+# index of worker process and file with its devices when devices are split between processes by the supervisor
+shard = os.getenv('BROADLINKMQTTSHARD')
+shard_file = os.getenv('BROADLINKMQTTSHARDFILE')
+# every worker process publishes its own metrics
+metrics_topic = cf.get('metrics_topic', None)
+if metrics_topic is not None and shard is not None:
+    metrics_topic += '/shard' + shard
+
+if cf.get('command_store', None) is not None:
+    command_cache = StoredCommands(CodeStore(cf.get('command_store')), dirname + "commands/")
+else:
+    command_cache = CommandCache(cf.get('command_cache_size', 1048576))
+macro_cache = MacroCache(command_cache)
+metrics = Metrics()
+rf_frequencies = RFFrequencies(cf.get('rf_frequency_file', dirname + 'rf_frequencies.json'))
+publish_filter = PublishFilter(cf.get('mqtt_publish_changes_only', False),
+                               cf.get('mqtt_publish_deadband', 0),
+                               cf.get('mqtt_publish_heartbeat', 300))
+publisher = Publisher(cf.get('mqtt_publish_buffer_size', 1000))
+read_cache = ReadCache()
 
 
 # noinspection PyUnusedLocal
-def on_message(client, device, msg):
-    command = msg.topic[len(topic_prefix):]
+def on_message(client, router, msg):
+    start = time.monotonic()
+    if msg.topic == settings.reload_topic:
+        start_reload(router)
+        return
+    if msg.topic == metrics_topic:
+        # metrics topic may be under the topic prefix the bridge is subscribed to
+        return
+    route_message(router, msg)
+    metrics.observe('broadlink_mqtt_dispatch_seconds', time.monotonic() - start)
 
-    if isinstance(device, dict):
-        for subprefix in device:
-            if command.startswith(subprefix):
-                device = device[subprefix]
-                command = command[len(subprefix):]
-                break
-        else:
-            logging.error("MQTT topic %s has no recognized device reference, expected one of %s" %
-                          (msg.topic, ','.join(device.keys())))
+
+def route_message(router, msg):
+    current = settings
+    device, command = router.resolve(msg.topic[len(current.topic_prefix):])
+    if device is None:
+        logging.error("MQTT topic %s has no recognized device reference, expected one of %s" %
+                      (msg.topic, ','.join(router.subprefixes())))
+        return
+
+    if current.command_subprefix:
+        if not command.startswith(current.command_subprefix):
             return
+        command = command[len(current.command_subprefix):]
 
     # internal notification
-    if command == 'temperature' or \
-            command == 'humidity' or \
-            command == 'energy' or \
-            command == 'sensors' or \
-            command == 'position' or \
-            command == 'state' or \
-            command.startswith('state/') or \
-            command.startswith('sensor/'):
+    level, separator, rest = command.partition('/')
+    if command in STATE_TOPICS or (separator and level in STATE_TOPIC_LEVELS):
         return
 
     try:
-        action = msg.payload.decode('utf-8').lower()
+        action = msg.payload.decode('utf-8')
+        if not is_batch(command, action):
+            action = action.lower()
         logging.debug("Received MQTT message " + msg.topic + " " + action)
-
-        # SP1/2 / MP1/ BG1 power control
-        if command == 'power':
-            if device.type == 'SP1' or device.type == 'SP2' or device.type == 'SP3S':
-                state = action == 'on' or action == '1'
-                logging.debug("Setting power state to {0}".format(state))
-                device.set_power(1 if state else 0)
+        if command == 'refresh':
+            # values are read next to polls, not after commands waiting in the queue of the device
+            scheduler.executor.submit(refresh, device)
+            return
+        if command == 'cancel' or is_command_in(CANCELLING_COMMANDS.get(device.type, ()), command, action):
+            # command being executed is stopped right away, not after commands received before
+            device.worker.cancel()
+            if command == 'cancel':
                 return
+        # device commands are executed by the worker of the device, never in the MQTT network thread
+        device.worker.submit_command(command, action)
+    except Exception:
+        logging.exception("Error")
 
-            if device.type == 'MP1':
-                parts = action.split("/", 2)
-                if len(parts) == 2:
-                    sid = int(parts[0])
-                    state = parts[1] == 'on' or parts[1] == '1'
-                    logging.debug("Setting power state of socket {0} to {1}".format(sid, state))
-                    device.set_power(sid, state)
-                    return
 
-            if device.type == 'BG1':
-                state = action == 'on' or action == '1'
-                logging.debug("Setting power state of all sockets to {0}".format(state))
-                device.set_state(pwr1=state, pwr2=state)
-                return
+def is_command_in(commands, command, action):
+    level = command.partition('/')[0]
+    return (level, None) in commands or (level, action) in commands or (None, action) in commands
 
-        # MP1 power control
-        if command.startswith('power/') and device.type == 'MP1':
-            sid = int(command[6:])
-            state = action == 'on' or action == '1'
-            logging.debug("Setting power state of socket {0} to {1}".format(sid, state))
-            device.set_power(sid, state)
-            return
 
-        # BG1 power control
-        if command.startswith('power/') and device.type == 'BG1':
-            sid = int(command[6:])
-            state = action == 'on' or action == '1'
-            logging.debug("Setting power state of socket {0} to {1}".format(sid, state))
-            if sid == 1:
-                device.set_state(pwr1=state)
-            elif sid == 2:
-                 device.set_state(pwr2=state)
-            return
+def dispatch_command(device, command, action):
+    handlers = COMMAND_HANDLERS.get(device.type, {})
+    handler = handlers.get(command)
+    if handler is None:
+        level, separator, rest = command.partition('/')
+        handler = handlers.get(level + '/') if separator else None
+    if handler is None:
+        handler = handlers.get(None)
+    if handler is None or handler(device, command, action) is False:
+        logging.warning("Unrecognized MQTT message " + action)
+    # command may change state of the device, so it's read again on the next refresh
+    read_cache.forget(device)
+
+
+# SP1/2 power control
+def handle_sp_power(device, command, action):
+    state = action == 'on' or action == '1'
+    logging.debug("Setting power state to {0}".format(state))
+    device.set_power(1 if state else 0)
+
+
+# MP1 power control
+def handle_mp1_power(device, command, action):
+    parts = action.split("/", 2)
+    if len(parts) != 2:
+        return False
+    sid = int(parts[0])
+    state = parts[1] == 'on' or parts[1] == '1'
+    logging.debug("Setting power state of socket {0} to {1}".format(sid, state))
+    device.set_power(sid, state)
+
+
+def handle_mp1_socket_power(device, command, action):
+    sid = int(command[6:])
+    state = action == 'on' or action == '1'
+    logging.debug("Setting power state of socket {0} to {1}".format(sid, state))
+    device.set_power(sid, state)
+
+
+# BG1 power control
+def handle_bg1_power(device, command, action):
+    state = action == 'on' or action == '1'
+    logging.debug("Setting power state of all sockets to {0}".format(state))
+    device.set_state(pwr1=state, pwr2=state)
+
+
+def handle_bg1_socket_power(device, command, action):
+    sid = int(command[6:])
+    state = action == 'on' or action == '1'
+    logging.debug("Setting power state of socket {0} to {1}".format(sid, state))
+    if sid == 1:
+        device.set_state(pwr1=state)
+    elif sid == 2:
+        device.set_state(pwr2=state)
+
+
+# BG1 led brightness
+def handle_bg1_brightness(device, command, action):
+    state = int(action)
+    logging.debug("Setting led brightness to {0}".format(state))
+    device.set_state(idcbrightness=state)
+
+
+# Dooya curtain control
+def handle_dooya_action(device, command, action):
+    if action == 'open':
+        logging.debug("Opening curtain")
+        device.open()
+        device.publish(100)
+    elif action == 'close':
+        logging.debug("Closing curtain")
+        device.close()
+        device.publish(0)
+    elif action == 'stop':
+        logging.debug("Stopping curtain")
+        device.stop()
+        device.publish(device.get_percentage())
+    else:
+        logging.warning("Unrecognized curtain action " + action)
+
+
+def handle_dooya_set(device, command, action):
+    percentage = int(action)
+    logging.debug("Setting curtain position to {0}".format(percentage))
+    # same as set_percentage_and_wait of the library, but can be interrupted by stop action
+    current = device.get_percentage()
+    closing = current > percentage
+    if closing:
+        device.close()
+    elif current < percentage:
+        device.open()
+    while current is not None and (current > percentage if closing else current < percentage):
+        if device.worker.pause(0.2):
+            logging.debug("Setting of curtain position is cancelled")
+            break
+        current = device.get_percentage()
+    device.stop()
+    device.publish(device.get_percentage())
 
-        # BG1 led brightness
-        if command == 'brightness' and device.type == 'BG1':
-            state = int(action)
-            logging.debug("Setting led brightness to {0}".format(state))
-            device.set_state(idcbrightness=state)
-            return
 
-        # Dooya curtain control
-        if command == 'action':
-            if device.type == 'Dooya DT360E':
-                if action == 'open':
-                    logging.debug("Opening curtain")
-                    device.open()
-                    device.publish(100)
-                elif action == 'close':
-                    logging.debug("Closing curtain")
-                    device.close()
-                    device.publish(0)
-                elif action == 'stop':
-                    logging.debug("Stopping curtain")
-                    device.stop()
-                    device.publish(device.get_percentage())
-                else:
-                    logging.warning("Unrecognized curtain action " + action)
-                return
+# RM2/RM4 record/replay control
+def handle_rm_command(device, command, action):
+    file = dirname + "commands/" + command
+    handy_file = file + '/' + action
+
+    if command == 'macro':
+        file = dirname + "macros/" + action
+        macro(device, file)
+    elif action == '' or action == 'auto':
+        record_or_replay(device, file)
+    elif action == 'autorf':
+        record_or_replay_rf(device, file)
+    elif command_cache.get(handy_file) is not None:
+        replay(device, handy_file)
+    elif action == 'record':
+        record(device, file)
+    elif action == 'recordrf':
+        record_rf(device, file)
+    elif action == 'cancel':
+        cancel_learning(device)
+    elif action == 'replay':
+        replay(device, file)
+    elif action == 'macro':
+        file = dirname + "macros/" + command
+        macro(device, file)
+    else:
+        return False
+
+
+def handle_rm_batch(device, command, action):
+    if not is_batch(command, action):
+        # recorded command named 'batch'
+        return handle_rm_command(device, command, action)
+    run_plan(device, compile_batch(action))
+
+
+def is_batch(command, action):
+    """Returns True if the message is a batch, any payload other than JSON array is a command named 'batch'"""
+    return command == 'batch' and action.lstrip().startswith('[')
+
+
+def command_plan(device, command, action):
+    """Returns plan of the command if it's a macro or a batch, so asyncio runtime can await its pauses,
+    or None for any other command"""
+    if COMMAND_HANDLERS.get(device.type) is not RM_HANDLERS:
+        return None
+    if is_batch(command, action):
+        return compile_batch(action)
+    if command == 'macro':
+        return macro_cache.get(dirname + "macros/" + action)
+    if action == 'macro' and command_cache.get(dirname + "commands/" + command + '/macro') is None:
+        return macro_cache.get(dirname + "macros/" + command)
+    return None
+
+
+# topics published by the bridge itself
+STATE_TOPICS = frozenset(['temperature', 'humidity', 'energy', 'sensors', 'position', 'state', 'availability',
+                          'learning', 'error'])
+STATE_TOPIC_LEVELS = frozenset(['state', 'sensor'])
+
+# handlers of commands by device type and command, 'command/' key matches all sub-topics of the command,
+# None key matches any other command
+SP_HANDLERS = {'power': handle_sp_power}
+RM_HANDLERS = {None: handle_rm_command, 'batch': handle_rm_batch}
+COMMAND_HANDLERS = {
+    'SP1': SP_HANDLERS,
+    'SP2': SP_HANDLERS,
+    'SP3S': SP_HANDLERS,
+    'MP1': {'power': handle_mp1_power, 'power/': handle_mp1_socket_power},
+    'BG1': {'power': handle_bg1_power, 'power/': handle_bg1_socket_power, 'brightness': handle_bg1_brightness},
+    'Dooya DT360E': {'action': handle_dooya_action, 'set': handle_dooya_set},
+    'RM2': RM_HANDLERS,
+    'RM4': RM_HANDLERS,
+    'RM4PRO': RM_HANDLERS,
+    'RMMINI': RM_HANDLERS,
+    'RM4MINI': RM_HANDLERS,
+    'RMMINIB': RM_HANDLERS,
+    'RMPRO': RM_HANDLERS,
+}
+
+# (first topic level, payload) of commands executed ahead of queued ones by device type, None matches anything
+POWER_PRIORITY = frozenset([('power', None)])
+RM_PRIORITY = frozenset([(None, 'cancel')])  # cancelling of learning
+PRIORITY_COMMANDS = {
+    'SP1': POWER_PRIORITY,
+    'SP2': POWER_PRIORITY,
+    'SP3S': POWER_PRIORITY,
+    'MP1': POWER_PRIORITY,
+    'BG1': POWER_PRIORITY,
+    'Dooya DT360E': frozenset([('action', 'stop')]),
+    'RM2': RM_PRIORITY,
+    'RM4': RM_PRIORITY,
+    'RM4PRO': RM_PRIORITY,
+    'RMMINI': RM_PRIORITY,
+    'RM4MINI': RM_PRIORITY,
+    'RMMINIB': RM_PRIORITY,
+    'RMPRO': RM_PRIORITY,
+}
+# commands stopping the command being executed as soon as they are received by device type,
+# 'cancel' topic of any device does the same and nothing else
+CANCELLING_COMMANDS = {
+    'Dooya DT360E': frozenset([('action', 'stop')]),
+}
 
-        if command == 'set' and device.type == 'Dooya DT360E':
-            percentage = int(action)
-            logging.debug("Setting curtain position to {0}".format(percentage))
-            device.set_percentage_and_wait(percentage)
-            device.publish(device.get_percentage())
-            return
 
-        # RM2/RM4 record/replay control
-        if device.type == 'RM2' or device.type == 'RM4' or device.type == 'RM4PRO' or device.type == 'RMMINI' or device.type == 'RM4MINI' or device.type == 'RMMINIB' or device.type == 'RMPRO':
-            file = dirname + "commands/" + command
-            handy_file = file + '/' + action
+# noinspection PyUnusedLocal
+def on_connect(client, router, flags, result_code, properties=None):
+    metrics.inc('broadlink_mqtt_connects_total')
+    if settings.birth_payload:
+        mqttc.publish(settings.birth_topic, payload=settings.birth_payload, qos=0, retain=True)
 
-            if command == 'macro':
-                file = dirname + "macros/" + action
-                macro(device, file)
-                return
-            elif action == '' or action == 'auto':
-                record_or_replay(device, file)
-                return
-            elif action == 'autorf':
-                record_or_replay_rf(device, file)
-                return
-            elif os.path.isfile(handy_file):
-                replay(device, handy_file)
-                return
-            elif action == 'record':
-                record(device, file)
-                return
-            elif action == 'recordrf':
-                record_rf(device, file)
-                return
-            elif action == 'replay':
-                replay(device, file)
-                return
-            elif action == 'macro':
-                file = dirname + "macros/" + command
-                macro(device, file)
-                return
+    for device in router.devices():
+        device.session.publish()
+    publisher.set_connected(True)
 
-        logging.warning("Unrecognized MQTT message " + action)
-    except Exception:
-        logging.exception("Error")
+    for topic in client_topics(router):
+        logging.debug("Connected to MQTT broker, subscribing to topic " + topic)
+        subscribe(topic)
 
 
-# noinspection PyUnusedLocal
-def on_connect(client, device, flags, result_code):
-    if cf.get('mqtt_birth_payload', False):
-        mqttc.publish(cf.get('mqtt_birth_topic', 'clients/broadlink'), payload=cf.get('mqtt_birth_payload'), qos=0, retain=True)
+def client_topics(router):
+    """Returns all topics the bridge subscribes to"""
+    current = settings
+    if current.command_subprefix or shard is not None:
+        topics = subscription_topics(router.subprefixes())
+    else:
+        topics = [current.topic_prefix + '#']
+    if current.reload_topic:
+        topics.append(current.reload_topic)
+    return topics
 
-    topic = topic_prefix + '#'
-    logging.debug("Connected to MQTT broker, subscribing to topic " + topic)
-    mqttc.subscribe(topic, qos)
+
+def subscription_topics(subprefixes):
+    current = settings
+    if not current.command_subprefix and shard is None:
+        return []
+    # only command topics of every device, so messages published by the bridge itself are not received back
+    # and worker processes don't receive messages of devices of other workers
+    return [current.topic_prefix + subprefix + current.command_subprefix + '#' for subprefix in subprefixes]
+
+
+def subscribe(topic):
+    if mqtt_protocol == paho.MQTTv5:
+        # no local option prevents receiving of messages published by the bridge itself
+        mqttc.subscribe(topic, options=paho.SubscribeOptions(qos=settings.qos, noLocal=True))
+    else:
+        mqttc.subscribe(topic, settings.qos)
 
 
 # noinspection PyUnusedLocal
-def on_disconnect(client, device, rc):
+def on_disconnect(client, router, rc, properties=None):
     logging.warning("OOOOPS! MQTT disconnection")
-    time.sleep(10)
+    metrics.inc('broadlink_mqtt_disconnects_total')
+    publisher.set_connected(False)
+
+
+def publish_state(topic, value, force=False):
+    levels = topic.rsplit('/', 2)
+    topic_class = levels[-2] if len(levels) > 2 and levels[-2] in STATE_TOPIC_LEVELS else levels[-1]
+    if publish_filter.accept(topic, value, force):
+        current = settings
+        publisher.publish(topic, value, qos=current.qos, retain=current.retain)
+        metrics.inc('broadlink_mqtt_published_total', topic=topic_class)
+    else:
+        metrics.inc('broadlink_mqtt_suppressed_total', topic=topic_class)
 
 
 def record_or_replay(device, file):
-    if os.path.isfile(file):
+    if command_cache.get(file) is not None:
         replay(device, file)
     else:
         record(device, file)
 
 
 def record_or_replay_rf(device, file):
-    if os.path.isfile(file):
+    if command_cache.get(file) is not None:
         replay(device, file)
     else:
         record_rf(device, file)
@@ -250,99 +1039,143 @@ def record_or_replay_rf(device, file):
 
 def record(device, file):
     logging.debug("Recording command to file " + file)
-    # receive packet
-    device.enter_learning()
-    ir_packet = None
-    attempt = 0
-    while ir_packet is None and attempt < 8:
-        attempt = attempt + 1
-        time.sleep(5)
-        try:
-            ir_packet = device.check_data()
-        except (broadlink.exceptions.ReadError, broadlink.exceptions.StorageError):
-            continue
-    if ir_packet is not None:
-        # write to file
-        directory = os.path.dirname(file)
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-        with open(file, 'wb') as f:
-            f.write(binascii.hexlify(ir_packet))
-        logging.debug("Done")
-    else:
-        logging.warning("No command received")
+    start_learning(Learning(device, file))
 
 
 def record_rf(device, file):
     logging.debug("Recording RF command to file " + file)
-    logging.debug("Learning RF Frequency, press and hold the button to learn...")
+    start_learning(Learning(device, file, rf=True))
 
-    device.sweep_frequency()
-    timeout = 20
 
-    while (not device.check_frequency()) and (timeout > 0):
-        time.sleep(1)
-        timeout -= 1
+def start_learning(learning):
+    device = learning.device
+    if getattr(device, 'learning', None) is not None:
+        device.learning.cancel()
+    device.learning = learning
+    learning.start()
 
-    if timeout <= 0:
-        logging.warn("RF Frequency not found")
-        device.cancel_sweep_frequency()
-        return
 
-    logging.debug("Found RF Frequency - 1 of 2!")
-    time.sleep(5)
-    logging.debug("To complete learning, single press the button you want to learn")
-
-    # receive packet
-    device.find_rf_packet()
-    rf_packet = None
-    attempt = 0
-    while rf_packet is None and attempt < 6:
-        time.sleep(5)
-        rf_packet = device.check_data()
-        attempt = attempt + 1
-    if rf_packet is not None:
-        # write to file
-        directory = os.path.dirname(file)
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-        with open(file, 'wb') as f:
-            f.write(binascii.hexlify(rf_packet))
-        logging.debug("Done")
+def cancel_learning(device):
+    if getattr(device, 'learning', None) is not None:
+        device.learning.cancel()
     else:
-        logging.warn("No command received")
-
-
-def replay(device, file):
-    logging.debug("Replaying command from file " + file)
-    with open(file, 'rb') as f:
-        ir_packet = f.read()
-    device.send_data(binascii.unhexlify(ir_packet.strip()))
+        logging.warning("Nothing to cancel, device is not learning")
+
+
+def replay(device, file, count=1):
+    logging.debug("Replaying command from file " + file + (" %d times" % count if count > 1 else ""))
+    ir_packet = command_cache.get(file)
+    if ir_packet is None:
+        raise IOError(errno.ENOENT, "Command file not found", file)
+    for packet in repeat_packet(ir_packet, count):
+        send_data(device, packet)
+
+
+def replay_file(device, command, action):
+    """Returns file of recorded command if the command is its replay, so identical replays can be coalesced,
+    or None for any other command"""
+    if COMMAND_HANDLERS.get(device.type) is not RM_HANDLERS or command == 'macro' or is_batch(command, action):
+        return None
+    file = dirname + "commands/" + command
+    if action in ('', 'auto', 'autorf'):
+        return file if command_cache.get(file) is not None else None
+    if command_cache.get(file + '/' + action) is not None:
+        return file + '/' + action
+    if action == 'replay' and command_cache.get(file) is not None:
+        return file
+    return None
+
+
+# first byte of Broadlink packets: IR, RF 433 MHz, RF 315 MHz
+REPEATABLE_PACKETS = (0x26, 0xb2, 0xd7)
+
+
+def repeat_packet(packet, count):
+    """Returns packets sending the packet count times, using repeat count of Broadlink IR/RF packet
+    (second byte, the packet is sent one more time than its value) to send as few packets as possible"""
+    if count == 1 or len(packet) < 4 or packet[0] not in REPEATABLE_PACKETS:
+        return [packet] * count
+    sends = packet[1] + 1
+    per_packet = max(1, 256 // sends)
+    packets = []
+    while count > 0:
+        copies = min(count, per_packet)
+        repeated = bytearray(packet)
+        repeated[1] = sends * copies - 1
+        packets.append(bytes(repeated))
+        count -= copies
+    return packets
+
+
+def coalesced(device, count):
+    if count > 1:
+        logging.debug("Coalesced %d presses of the same command of device %s" % (count, device.type))
+        metrics.inc('broadlink_mqtt_coalesced_commands_total', count - 1, device=device_id(device))
 
 
 def macro(device, file):
     logging.debug("Replaying macro from file " + file)
-    with open(file, 'r') as f:
-        for line in f:
-            line = line.strip(' \n\r\t')
-            if len(line) == 0 or line.startswith("#"):
-                continue
-            if line.startswith("pause "):
-                pause = int(line[6:].strip())
-                logging.debug("Pause for " + str(pause) + " milliseconds")
-                time.sleep(pause / 1000.0)
-            else:
-                command_file = dirname + "commands/" + line
-                replay(device, command_file)
+    run_plan(device, macro_cache.get(file))
+
+
+def compile_batch(payload):
+    """Converts JSON array of commands to a plan of ('send', packet) and ('pause', seconds) steps.
+    Every element is either a command path or an object {"command": path, "repeat": count, "delay": milliseconds}
+    where delay is a pause after every repeat of the command"""
+    steps = json.loads(payload)
+    if not isinstance(steps, list):
+        raise ValueError("Batch should be a JSON array of commands")
+    plan = []
+    missing = []
+    for step in steps:
+        if isinstance(step, dict):
+            command = step['command']
+            repeat = int(step.get('repeat', 1))
+            delay = int(step.get('delay', 0)) / 1000.0
+        else:
+            command, repeat, delay = step, 1, 0
+        packet = command_cache.get(dirname + "commands/" + command)
+        if packet is None:
+            missing.append(command)
+            continue
+        for i in range(repeat):
+            plan.append(('send', packet))
+            if delay > 0:
+                plan.append(('pause', delay))
+    if missing:
+        raise IOError(errno.ENOENT, "Batch references missing commands", ', '.join(missing))
+    return plan
+
+
+def run_plan(device, plan):
+    for step, value in plan:
+        if step == 'pause':
+            logging.debug("Pause for " + str(int(value * 1000)) + " milliseconds")
+            cancelled = device.worker.pause(value)
+        else:
+            # priority commands received meanwhile are executed between steps
+            cancelled = device.worker.pause(0)
+            if not cancelled:
+                send_data(device, value)
+        if cancelled:
+            logging.debug("Execution of command is cancelled")
+            return
+
+
+def send_data(device, packet):
+    start = time.monotonic()
+    device.send_data(packet)
+    metrics.observe('broadlink_mqtt_send_seconds', time.monotonic() - start, device=device_id(device))
+
+
+def device_id(device):
+    return ''.join(format(s, '02x') for s in device.mac)
 
 
 def get_device(cf):
     device_type = cf.get('device_type', 'lookup')
     if device_type == 'lookup':
-        local_address = cf.get('local_address', None)
-        lookup_timeout = cf.get('lookup_timeout', 20)
-        devices = broadlink.discover(timeout=lookup_timeout) if local_address is None else \
-            broadlink.discover(timeout=lookup_timeout, local_ip_address=local_address)
+        devices = lookup_devices(cf)
         if len(devices) == 0:
             logging.error('No Broadlink device found')
             sys.exit(2)
@@ -351,28 +1184,22 @@ def get_device(cf):
                           ', '.join([d.type + '/' + d.host[0] + '/' + ':'.join(format(s, '02x') for s in d.mac[::-1]) for d in devices]) +
                           ')')
             sys.exit(2)
-        return configure_device(devices[0], topic_prefix)
+        return configure_device(devices[0], settings.topic_prefix)
     elif device_type == 'multiple_lookup':
-        local_address = cf.get('local_address', None)
-        lookup_timeout = cf.get('lookup_timeout', 20)
-        devices = broadlink.discover(timeout=lookup_timeout) if local_address is None else \
-            broadlink.discover(timeout=lookup_timeout, local_ip_address=local_address)
+        devices = shard_devices(shard_file) if shard is not None else lookup_devices(cf)
         if len(devices) == 0:
             logging.error('No Broadlink devices found')
             sys.exit(2)
-        mqtt_multiple_prefix_format = cf.get('mqtt_multiple_subprefix_format', None)
         devices_dict = {}
         for device in devices:
-            mqtt_subprefix = mqtt_multiple_prefix_format.format(
-                type=device.type,
-                host=device.host[0],
-                mac='_'.join(format(s, '02x') for s in device.mac),
-                mac_nic='_'.join(format(s, '02x') for s in device.mac[3::]))
-            device = configure_device(device, topic_prefix + mqtt_subprefix)
+            mqtt_subprefix = get_subprefix(cf, device)
+            device = configure_device(device, settings.topic_prefix + mqtt_subprefix)
             devices_dict[mqtt_subprefix] = device
         return devices_dict
     elif device_type == 'test':
-        return configure_device(TestDevice(cf), topic_prefix)
+        device = TestDevice(cf)
+        device.auth()
+        return configure_device(device, settings.topic_prefix)
     else:
         host = (cf.get('device_host'), 80)
         mac = bytearray.fromhex(cf.get('device_mac').replace(':', ' '))
@@ -397,237 +1224,1579 @@ def get_device(cf):
         else:
             logging.error('Incorrect device configured: ' + device_type)
             sys.exit(2)
-        return configure_device(device, topic_prefix)
+        device.auth()
+        return configure_device(device, settings.topic_prefix)
+
+
+def get_subprefix(cf, device):
+    mqtt_multiple_prefix_format = cf.get('mqtt_multiple_subprefix_format', None)
+    return mqtt_multiple_prefix_format.format(
+        type=device.type,
+        host=device.host[0],
+        mac='_'.join(format(s, '02x') for s in device.mac),
+        mac_nic='_'.join(format(s, '02x') for s in device.mac[3::]))
+
+
+def discover_devices(cf):
+    local_address = cf.get('local_address', None)
+    lookup_timeout = cf.get('lookup_timeout', 20)
+    return broadlink.discover(timeout=lookup_timeout) if local_address is None else \
+        broadlink.discover(timeout=lookup_timeout, local_ip_address=local_address)
+
+
+def lookup_devices(cf):
+    """Returns authenticated devices found in the network or saved in the lookup cache file by previous lookup"""
+    cache_file = cf.get('lookup_cache_file', None)
+    devices = load_devices(cache_file) if cache_file is not None else []
+    if devices:
+        failed = authenticate_devices(devices)
+        if len(failed) < len(devices):
+            logging.debug('Using %d devices from lookup cache file %s' % (len(devices), cache_file))
+            # devices failed to authenticate are kept, they will be re-authenticated as unavailable ones later
+            for device in failed:
+                device.unavailable = True
+            for device in devices:
+                device.cached = True
+            return devices
+        logging.warning('No devices from lookup cache file %s are available, looking up devices' % cache_file)
+
+    devices = discover_devices(cf)
+    failed = authenticate_devices(devices)
+    if failed:
+        raise failed[0].auth_error
+    if cache_file is not None:
+        save_devices(cache_file, devices)
+    return devices
+
+
+def shard_devices(file):
+    """Returns devices given to this worker process by the supervisor, devices failed to authenticate are kept
+    as unavailable ones"""
+    devices = load_devices(file)
+    for device in authenticate_devices(devices):
+        device.unavailable = True
+    return devices
+
+
+def authenticate_devices(devices):
+    """Authenticates devices in parallel and returns list of devices failed to authenticate"""
+    def authenticate(device):
+        try:
+            device.auth()
+            return True
+        except Exception as e:
+            logging.warning('Cannot authenticate device %s at %s: %s' % (device.type, device.host[0], e))
+            device.auth_error = e
+            return False
+
+    if not devices:
+        return []
+    with ThreadPoolExecutor(max_workers=min(len(devices), 32)) as executor:
+        results = list(executor.map(authenticate, devices))
+    return [device for device, result in zip(devices, results) if not result]
+
+
+def load_devices(cache_file):
+    if not os.path.isfile(cache_file):
+        return []
+    try:
+        with open(cache_file, 'r') as f:
+            entries = json.load(f)
+        return [broadlink.gendevice(entry['devtype'], (entry['host'], entry['port']), bytearray.fromhex(entry['mac']))
+                for entry in entries]
+    except Exception:
+        logging.exception("Cannot read lookup cache file " + cache_file)
+        return []
+
+
+def save_devices(cache_file, devices):
+    entries = [{'type': device.type, 'devtype': device.devtype, 'host': device.host[0], 'port': device.host[1],
+                'mac': binascii.hexlify(device.mac).decode('ascii')} for device in devices]
+    try:
+        with open(cache_file + '.tmp', 'w') as f:
+            json.dump(entries, f, indent=2)
+        os.rename(cache_file + '.tmp', cache_file)
+    except (IOError, OSError):
+        logging.exception("Cannot write lookup cache file " + cache_file)
+
+
+def metrics_loop(topic, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            publish_metrics(topic)
+        except Exception:
+            logging.exception("Error")
+
+
+def publish_metrics(topic):
+    publisher.publish(topic, json.dumps(metrics.summary(), sort_keys=True), qos=settings.qos, retain=False)
+
+
+def lookup_loop(cf, router, interval, immediate):
+    """Repeats lookup of devices in background every interval seconds (only once if interval is 0)"""
+    if not immediate:
+        time.sleep(interval)
+    while True:
+        try:
+            update_devices(cf, router)
+        except Exception:
+            logging.exception("Error")
+        if interval <= 0:
+            return
+        time.sleep(interval)
+
+
+def update_devices(cf, router):
+    """Looks up devices and applies found changes to the running bridge"""
+    multiple = cf.get('device_type', 'lookup') == 'multiple_lookup'
+    retire_after = cf.get('lookup_retire_after', 3)
+    found = discover_devices(cf)
+    known = dict((bytes(device.mac), (subprefix, device)) for subprefix, device in router.items())
+
+    for device in found:
+        subprefix, current = known.pop(bytes(device.mac), (None, None))
+        if current is None:
+            if not multiple:
+                logging.warning('New device %s found at %s, it is ignored as only one device is supported' %
+                                (device.type, device.host[0]))
+                continue
+            logging.info('New device %s found at %s' % (device.type, device.host[0]))
+            if authenticate_devices([device]):
+                continue
+            subprefix = get_subprefix(cf, device)
+            configure_device(device, settings.topic_prefix + subprefix)
+            router.add(subprefix, device)
+            for topic in subscription_topics([subprefix]):
+                subscribe(topic)
+            device.session.publish()
+            continue
+
+        current.lookup_misses = 0
+        if current.host != device.host:
+            logging.info('Device %s moved from %s to %s' % (device.type, current.host[0], device.host[0]))
+            current.host = device.host
+            try:
+                current.session.authenticate()
+            except DeviceUnavailableError as e:
+                logging.warning(str(e))
+
+    for subprefix, device in known.values():
+        device.lookup_misses = getattr(device, 'lookup_misses', 0) + 1
+        if not multiple or device.lookup_misses < retire_after:
+            logging.warning('Device %s at %s was not found by lookup' % (device.type, device.host[0]))
+            continue
+        logging.info('Device %s at %s was not found by lookup %d times, removing it' %
+                     (device.type, device.host[0], device.lookup_misses))
+        router.remove(subprefix)
+        scheduler.remove(device)
+        read_cache.forget(device)
+        device.worker.stop()
+        for topic in subscription_topics([subprefix]):
+            mqttc.unsubscribe(topic)
+        device.session.stop()
+
+    cache_file = cf.get('lookup_cache_file', None)
+    if cache_file is not None:
+        save_devices(cache_file, router.devices())
+
+
+def start_reload(router):
+    # configuration is reloaded in background, as it may wait for locks held by MQTT network loop
+    reload_thread = Thread(target=reload_settings, args=(router,))
+    reload_thread.daemon = True
+    reload_thread.start()
+
+
+def reload_settings(router):
+    """Reads configuration files again and applies changed settings to the running bridge without reconnecting
+    devices or MQTT broker"""
+    global cf, settings
+    try:
+        config = Config()
+        new_settings = load_settings(config)
+    except (Exception, SystemExit) as e:
+        logging.error("Cannot reload configuration, keeping current one: %s" % e)
+        return False
+
+    old_settings = settings
+    old_topics = client_topics(router)
+    cf = config
+    settings = new_settings
+    metrics.inc('broadlink_mqtt_config_reloads_total')
+    logging.info("Configuration reloaded")
+
+    prefix_changed = new_settings.topic_prefix != old_settings.topic_prefix
+    polls_changed = prefix_changed or \
+        any(getattr(new_settings, name) != getattr(old_settings, name) for name in POLL_SETTINGS)
+    for subprefix, device in router.items():
+        if prefix_changed:
+            device.mqtt_prefix = new_settings.topic_prefix + subprefix
+            device.session.mqtt_prefix = device.mqtt_prefix
+            device.session.publish()
+        if polls_changed:
+            scheduler.remove(device)
+            schedule_polls(device)
+
+    new_topics = client_topics(router)
+    if mqttc.is_connected():
+        for topic in old_topics:
+            if topic not in new_topics:
+                mqttc.unsubscribe(topic)
+        for topic in new_topics:
+            if topic not in old_topics or new_settings.qos != old_settings.qos:
+                subscribe(topic)
+    return True
 
 
 def configure_device(device, mqtt_prefix):
-    device.auth()
     logging.debug('Connected to \'%s\' Broadlink device at \'%s\' (MAC %s) and started listening to MQTT commands at \'%s#\' '
-                  % (device.type, device.host[0], ':'.join(format(s, '02x') for s in device.mac), mqtt_prefix))
-
-    broadlink_rm_temperature_interval = cf.get('broadlink_rm_temperature_interval', 0)
-    if (device.type == 'RM2' or device.type == 'RMPRO' or device.type == 'RM4' or device.type == 'RM4PRO' or device.type == 'RM4MINI') and broadlink_rm_temperature_interval > 0:
-        scheduler = sched.scheduler(time.time, time.sleep)
-        scheduler.enter(broadlink_rm_temperature_interval, 1, broadlink_rm_temperature_timer,
-                        [scheduler, broadlink_rm_temperature_interval, device, mqtt_prefix])
-        # scheduler.run()
-        tt = SchedulerThread(scheduler)
-        tt.daemon = True
-        tt.start()
-
-    broadlink_sp_energy_interval = cf.get('broadlink_sp_energy_interval', 0)
-    if (device.type == 'SP2' or device.type == 'SP3S') and broadlink_sp_energy_interval > 0:
-        scheduler = sched.scheduler(time.time, time.sleep)
-        scheduler.enter(broadlink_sp_energy_interval, 1, broadlink_sp_energy_timer,
-                        [scheduler, broadlink_sp_energy_interval, device, mqtt_prefix])
-        # scheduler.run()
-        tt = SchedulerThread(scheduler)
-        tt.daemon = True
-        tt.start()
-
-    broadlink_a1_sensors_interval = cf.get('broadlink_a1_sensors_interval', 0)
-    if device.type == 'A1' and broadlink_a1_sensors_interval > 0:
-        scheduler = sched.scheduler(time.time, time.sleep)
-        scheduler.enter(broadlink_a1_sensors_interval, 1, broadlink_a1_sensors_timer,
-                        [scheduler, broadlink_a1_sensors_interval, device, mqtt_prefix])
-        # scheduler.run()
-        tt = SchedulerThread(scheduler)
-        tt.daemon = True
-        tt.start()
-
-    broadlink_mp1_state_interval = cf.get('broadlink_mp1_state_interval', 0)
-    if device.type == 'MP1' and broadlink_mp1_state_interval > 0:
-        scheduler = sched.scheduler(time.time, time.sleep)
-        scheduler.enter(broadlink_mp1_state_interval, 1, broadlink_mp1_state_timer,
-                        [scheduler, broadlink_mp1_state_interval, device, mqtt_prefix])
-        # scheduler.run()
-        tt = SchedulerThread(scheduler)
-        tt.daemon = True
-        tt.start()
+                  % (device.type, device.host[0], ':'.join(format(s, '02x') for s in device.mac), mqtt_prefix + settings.command_subprefix))
+
+    device.mqtt_prefix = mqtt_prefix
+    # every call to the device gives up after this time, so a hung device doesn't hold a worker of polls
+    device.timeout = cf.get('broadlink_poll_timeout', 10)
+    device.session = DeviceSession(device, mqtt_prefix, cf.get('broadlink_failure_threshold', 3),
+                                   cf.get('broadlink_reauth_delay', 5), cf.get('broadlink_reauth_delay_max', 300),
+                                   not getattr(device, 'unavailable', False))
+    worker_class = AsyncDeviceWorker if runtime == 'asyncio' else DeviceWorker
+    device.worker = worker_class(device, cf.get('device_queue_size', 100), cf.get('device_queue_overflow', 'drop_oldest'))
+    device.worker.start()
 
     if device.type == 'Dooya DT360E':
         # noinspection PyUnusedLocal
-        def publish(dev, percentage):
+        def publish(dev, percentage, force=False):
             try:
                 percentage = str(percentage)
-                topic = mqtt_prefix + "position"
+                topic = dev.mqtt_prefix + "position"
                 logging.debug("Sending Dooya position " + percentage + " to topic " + topic)
-                mqttc.publish(topic, percentage, qos=qos, retain=retain)
+                publish_state(topic, percentage, force)
             except:
                 logging.exception("Error")
 
         device.publish = types.MethodType(publish, device)
 
-        broadlink_dooya_position_interval = cf.get('broadlink_dooya_position_interval', 0)
-        if broadlink_dooya_position_interval > 0:
-            scheduler = sched.scheduler(time.time, time.sleep)
-            scheduler.enter(broadlink_dooya_position_interval, 1, broadlink_dooya_position_timer,
-                            [scheduler, broadlink_dooya_position_interval, device])
-            # scheduler.run()
-            tt = SchedulerThread(scheduler)
-            tt.daemon = True
-            tt.start()
-
-    broadlink_bg1_state_interval = cf.get('broadlink_bg1_state_interval', 0)
-    if device.type == 'BG1' and broadlink_bg1_state_interval > 0:
-        scheduler = sched.scheduler(time.time, time.sleep)
-        scheduler.enter(broadlink_bg1_state_interval, 1, broadlink_bg1_state_timer,
-                        [scheduler, broadlink_bg1_state_interval, device, mqtt_prefix])
-        # scheduler.run()
-        tt = SchedulerThread(scheduler)
-        tt.daemon = True
-        tt.start()
-
+    schedule_polls(device)
     return device
 
 
-def broadlink_rm_temperature_timer(scheduler, delay, device, mqtt_prefix):
-    scheduler.enter(delay, 1, broadlink_rm_temperature_timer, [scheduler, delay, device, mqtt_prefix])
+def device_polls(device):
+    """Returns (interval, function, arguments) of periodic updates of the device with intervals of current settings"""
+    current = settings
+    mqtt_prefix = device.mqtt_prefix
+    polls = []
+    if device.type == 'RM2' or device.type == 'RMPRO' or device.type == 'RM4' or device.type == 'RM4PRO' or device.type == 'RM4MINI':
+        polls.append((current.rm_temperature_interval, broadlink_rm_temperature_timer, (device, mqtt_prefix)))
 
-    try:
-        temperature = str(device.check_temperature())
-        topic = mqtt_prefix + "temperature"
-        logging.debug("Sending RM temperature " + temperature + " to topic " + topic)
-        mqttc.publish(topic, temperature, qos=qos, retain=retain)
-
-        if device.type in ('RM4', 'RM4PRO'):
-            humidity = str(device.check_humidity())
-            topic = mqtt_prefix + "humidity"
-            logging.debug("Sending RM humidity " + humidity + " to topic " + topic)
-            mqttc.publish(topic, humidity, qos=qos, retain=retain)
-    except:
-        logging.exception("Error")
+    if device.type == 'SP2' or device.type == 'SP3S':
+        polls.append((current.sp_energy_interval, broadlink_sp_energy_timer, (device, mqtt_prefix)))
 
+    if device.type == 'A1':
+        polls.append((current.a1_sensors_interval, broadlink_a1_sensors_timer, (device, mqtt_prefix)))
 
-def broadlink_sp_energy_timer(scheduler, delay, device, mqtt_prefix):
-    scheduler.enter(delay, 1, broadlink_sp_energy_timer, [scheduler, delay, device, mqtt_prefix])
+    if device.type == 'MP1':
+        polls.append((current.mp1_state_interval, broadlink_mp1_state_timer, (device, mqtt_prefix)))
+
+    if device.type == 'Dooya DT360E':
+        polls.append((current.dooya_position_interval, broadlink_dooya_position_timer, (device,)))
+
+    if device.type == 'BG1':
+        polls.append((current.bg1_state_interval, broadlink_bg1_state_timer, (device, mqtt_prefix)))
+    return polls
 
-    try:
-        energy = str(device.get_energy())
-        topic = mqtt_prefix + "energy"
-        logging.debug("Sending SP energy " + energy + " to topic " + topic)
-        mqttc.publish(topic, energy, qos=qos, retain=retain)
-    except:
-        logging.exception("Error")
 
+def schedule_polls(device):
+    """Plans periodic updates of the device with intervals of current settings"""
+    for interval, func, args in device_polls(device):
+        if interval > 0:
+            scheduler.add(interval, func, *args)
 
-def broadlink_a1_sensors_timer(scheduler, delay, device, mqtt_prefix):
-    scheduler.enter(delay, 1, broadlink_a1_sensors_timer, [scheduler, delay, device, mqtt_prefix])
 
+def refresh(device):
+    """Reads and publishes all values of the device on request, values read within read cache TTL are reused"""
     try:
-        text_values = cf.get('broadlink_a1_sensors_text_values', False)
-        is_json = cf.get('broadlink_a1_sensors_json', False)
-        sensors = device.check_sensors() if text_values else device.check_sensors_raw()
-        if is_json:
-            topic = mqtt_prefix + "sensors"
-            value = json.dumps(sensors)
-            logging.debug("Sending A1 sensors '%s' to topic '%s'" % (value, topic))
-            mqttc.publish(topic, value, qos=qos, retain=retain)
-        else:
-            for name in sensors:
-                topic = mqtt_prefix + "sensor/" + name
-                value = str(sensors[name])
-                logging.debug("Sending A1 %s '%s' to topic '%s'" % (name, value, topic))
-                mqttc.publish(topic, value, qos=qos, retain=retain)
-    except:
+        device.session.run(refresh_device, device)
+    except DeviceUnavailableError as e:
+        logging.warning(str(e))
+        device.session.report(e)
+    except Exception as e:
         logging.exception("Error")
+        device.session.report(e)
 
 
-def broadlink_mp1_state_timer(scheduler, delay, device, mqtt_prefix):
-    scheduler.enter(delay, 1, broadlink_mp1_state_timer, [scheduler, delay, device, mqtt_prefix])
+def refresh_device(device):
+    for interval, func, args in device_polls(device):
+        func(*args, refresh=True)
 
-    try:
-        is_json = cf.get('broadlink_mp1_state_json', False)
-        state = device.check_power()
-        if is_json:
-            topic = mqtt_prefix + "state"
-            value = json.dumps(state)
-            logging.debug("Sending MP1 state '%s' to topic '%s'" % (value, topic))
-            mqttc.publish(topic, value, qos=qos, retain=retain)
-        elif state is not None:
-            for name in state:
-                topic = mqtt_prefix + "state/" + name
-                value = str(state[name])
-                logging.debug("Sending MP1 %s '%s' to topic '%s'" % (name, value, topic))
-                mqttc.publish(topic, value, qos=qos, retain=retain)
-    except:
-        logging.exception("Error")
 
+def read_value(device, method, refresh=False):
+    """Calls reading method of the device sharing the call with concurrent reads of the same value,
+    polls always read the device while refresh requests accept the value read within read cache TTL"""
+    return read_cache.read(device, method, settings.read_cache_ttl if refresh else 0)
 
-def broadlink_dooya_position_timer(scheduler, delay, device):
-    scheduler.enter(delay, 1, broadlink_dooya_position_timer, [scheduler, delay, device])
-    device.publish(device.get_percentage())
 
+def broadlink_rm_temperature_timer(device, mqtt_prefix, refresh=False):
+    temperature = str(read_value(device, 'check_temperature', refresh))
+    topic = mqtt_prefix + "temperature"
+    logging.debug("Sending RM temperature " + temperature + " to topic " + topic)
+    publish_state(topic, temperature, refresh)
 
-def broadlink_bg1_state_timer(scheduler, delay, device, mqtt_prefix):
-    scheduler.enter(delay, 1, broadlink_bg1_state_timer, [scheduler, delay, device, mqtt_prefix])
+    if device.type in ('RM4', 'RM4PRO'):
+        humidity = str(read_value(device, 'check_humidity', refresh))
+        topic = mqtt_prefix + "humidity"
+        logging.debug("Sending RM humidity " + humidity + " to topic " + topic)
+        publish_state(topic, humidity, refresh)
+
+
+def broadlink_sp_energy_timer(device, mqtt_prefix, refresh=False):
+    energy = str(read_value(device, 'get_energy', refresh))
+    topic = mqtt_prefix + "energy"
+    logging.debug("Sending SP energy " + energy + " to topic " + topic)
+    publish_state(topic, energy, refresh)
+
+
+def broadlink_a1_sensors_timer(device, mqtt_prefix, refresh=False):
+    text_values = settings.a1_sensors_text_values
+    is_json = settings.a1_sensors_json
+    sensors = read_value(device, 'check_sensors' if text_values else 'check_sensors_raw', refresh)
+    if is_json:
+        topic = mqtt_prefix + "sensors"
+        value = json.dumps(sensors)
+        logging.debug("Sending A1 sensors '%s' to topic '%s'" % (value, topic))
+        publish_state(topic, value, refresh)
+    else:
+        for name in sensors:
+            topic = mqtt_prefix + "sensor/" + name
+            value = str(sensors[name])
+            logging.debug("Sending A1 %s '%s' to topic '%s'" % (name, value, topic))
+            publish_state(topic, value, refresh)
+
+
+def broadlink_mp1_state_timer(device, mqtt_prefix, refresh=False):
+    is_json = settings.mp1_state_json
+    state = read_value(device, 'check_power', refresh)
+    if is_json:
+        topic = mqtt_prefix + "state"
+        value = json.dumps(state)
+        logging.debug("Sending MP1 state '%s' to topic '%s'" % (value, topic))
+        publish_state(topic, value, refresh)
+    elif state is not None:
+        for name in state:
+            topic = mqtt_prefix + "state/" + name
+            value = str(state[name])
+            logging.debug("Sending MP1 %s '%s' to topic '%s'" % (name, value, topic))
+            publish_state(topic, value, refresh)
+
+
+def broadlink_dooya_position_timer(device, refresh=False):
+    device.publish(read_value(device, 'get_percentage', refresh), refresh)
+
+
+def broadlink_bg1_state_timer(device, mqtt_prefix, refresh=False):
+    is_json = settings.bg1_state_json
+    state = read_value(device, 'get_state', refresh)
+    if is_json:
+        topic = mqtt_prefix + "state"
+        value = json.dumps(state)
+        logging.debug("Sending BG1 state '%s' to topic '%s'" % (value, topic))
+        publish_state(topic, value, refresh)
+    elif state is not None:
+        for name in state:
+            topic = mqtt_prefix + "state/" + name
+            value = str(state[name])
+            logging.debug("Sending BG1 %s '%s' to topic '%s'" % (name, value, topic))
+            publish_state(topic, value, refresh)
+
+
+class DeviceUnavailableError(Exception):
+    pass
+
+
+class DeviceSession(object):
+    """Circuit breaker of communication with a device: consecutive failures open it, so polls of unreachable device
+    are skipped and its commands are rejected right away instead of waiting for network timeouts, then single probes
+    re-authenticate the device at growing intervals until it answers again"""
+
+    # errors meaning that device is not reachable or its session key is not valid anymore
+    ERRORS = (broadlink.exceptions.AuthenticationError, broadlink.exceptions.AuthorizationError,
+              broadlink.exceptions.NetworkTimeoutError, socket.error)
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, device, mqtt_prefix, threshold, delay, max_delay, available=True):
+        self.device = device
+        self.mqtt_prefix = mqtt_prefix
+        self.threshold = threshold
+        self.initial_delay = delay
+        self.max_delay = max_delay
+        self.delay = delay
+        self.state = self.CLOSED
+        self.failures = 0  # consecutive failures while closed
+        self.retry_time = 0
+        self.available = available
+        self.stopped = False
+        self.lock = Lock()
+        if not available:
+            with self.lock:
+                self.open()
+
+    def ready(self):
+        """Returns False if calls to the device are rejected now"""
+        return self.state == self.CLOSED or (self.state == self.OPEN and time.monotonic() >= self.retry_time)
+
+    def run(self, func, *args):
+        probe = self.acquire()
+        try:
+            result = self.call(probe, func, args)
+        except self.ERRORS as e:
+            if isinstance(e, IOError) and e.filename is not None:
+                # errors of reading command files are not related to the device
+                self.succeeded()
+                raise
+            else:
+                self.failed(e)
+        except DeviceUnavailableError:
+            # shared read failed, it's counted by the session of the call made to the device
+            raise
+        except Exception:
+            # device answered, but the command failed for another reason
+            self.succeeded()
+            raise
+        self.succeeded()
+        return result
+
+    def acquire(self):
+        """Returns True if the call probes the device after it was unreachable,
+        raises DeviceUnavailableError if the call is rejected"""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return False
+            if self.state == self.OPEN and time.monotonic() >= self.retry_time:
+                self.state = self.HALF_OPEN
+                return True
+        metrics.inc('broadlink_mqtt_breaker_rejected_total', device=device_id(self.device))
+        raise DeviceUnavailableError("Device %s at %s is unavailable, next attempt in %g seconds" %
+                                     (self.device.type, self.device.host[0],
+                                      round(max(0, self.retry_time - time.monotonic()), 1)))
+
+    def call(self, probe, func, args):
+        if probe:
+            # session of the device was lost while it was unreachable
+            self.auth()
+            return func(*args)
+        try:
+            return func(*args)
+        except self.ERRORS as e:
+            if isinstance(e, IOError) and e.filename is not None:
+                raise
+            logging.warning("Communication with device %s at %s failed (%s), re-authenticating" %
+                            (self.device.type, self.device.host[0], e))
+        self.auth()
+        # retry failed command once with a new session
+        return func(*args)
+
+    def auth(self):
+        metrics.inc('broadlink_mqtt_auth_retries_total', device=device_id(self.device))
+        self.device.auth()
+
+    def authenticate(self):
+        """Re-authenticates the device right away, e.g. after it moved to another address"""
+        with self.lock:
+            if self.state != self.HALF_OPEN:
+                self.state = self.OPEN
+                self.retry_time = 0
+        self.run(lambda: None)
+
+    def open(self):
+        self.state = self.OPEN
+        self.retry_time = time.monotonic() + self.delay
+        scheduler.call_later(self.delay, self.probe)
+        self.delay = min(self.delay * 2, self.max_delay)
+
+    def failed(self, error):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.CLOSED and self.failures < self.threshold:
+                message = "Communication with device %s at %s failed (%s), %d of %d failures before it is unavailable" % \
+                          (self.device.type, self.device.host[0], error, self.failures, self.threshold)
+            else:
+                self.open()
+                message = "Device %s at %s is unavailable (%s), next attempt in %g seconds" % \
+                          (self.device.type, self.device.host[0], error, round(self.retry_time - time.monotonic(), 1))
+            available = self.state == self.CLOSED
+        self.set_available(available)
+        raise DeviceUnavailableError(message)
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+            if self.state != self.CLOSED:
+                logging.info("Device %s at %s is available again" % (self.device.type, self.device.host[0]))
+                self.state = self.CLOSED
+                self.delay = self.initial_delay
+        self.set_available(True)
+
+    def probe(self):
+        """Called by the scheduler when the device can be probed, it's done unless a poll or a command did it before"""
+        if not self.stopped and self.state == self.OPEN:
+            scheduler.executor.submit(self.run_probe)
+
+    def run_probe(self):
+        try:
+            self.run(lambda: None)
+        except DeviceUnavailableError as e:
+            logging.warning(str(e))
+
+    def stop(self):
+        """Stops probing of removed device"""
+        self.stopped = True
+        self.set_available(False)
+
+    def set_available(self, available):
+        if self.available != available:
+            self.available = available
+            metrics.set('broadlink_mqtt_device_available', 1 if available else 0, device=device_id(self.device))
+            self.publish()
+
+    def publish(self):
+        publisher.publish(self.mqtt_prefix + 'availability', 'online' if self.available else 'offline',
+                          qos=settings.qos, retain=True)
+
+    def report(self, error):
+        """Publishes error of failed or rejected command, so clients don't wait for its result"""
+        message = str(error) if isinstance(error, DeviceUnavailableError) else \
+            "%s: %s" % (error.__class__.__name__, error)
+        publisher.publish(self.mqtt_prefix + 'error', message, qos=settings.qos, retain=False)
+
+
+class Learning(object):
+    """Learning of IR/RF command as a sequence of short steps executed by the device worker, so the worker is not
+    blocked while waiting for the button to be pressed. Device is polled with interval growing from
+    learning_interval to learning_interval_max, so command pressed soon is saved soon.
+    RF learning starts from sweeping the frequency unless it's known from other commands of the same remote"""
+
+    def __init__(self, device, file, rf=False):
+        self.device = device
+        self.file = file
+        self.rf = rf
+        self.command = os.path.relpath(file, dirname + "commands").replace(os.sep, '/')
+        self.remote = os.path.dirname(self.command)
+        self.phase = None  # 'sweep', 'found' or 'capture'
+        self.started = time.monotonic()
+        self.finished = False
+        self.stored_frequency = False  # True if RF frequency remembered for the remote is used instead of sweeping
+        self.interval = self.deadline = None
+
+    def start(self):
+        if not self.rf:
+            self.device.enter_learning()
+            self.capture()
+            return
+
+        frequency = rf_frequencies.get(self.remote)
+        if frequency is not None:
+            try:
+                self.device.find_rf_packet(frequency)
+                self.stored_frequency = True
+                logging.debug("Using RF frequency %s of %s, press the button you want to learn" % (frequency, self.remote))
+                self.capture()
+                return
+            except TypeError:
+                # installed broadlink library doesn't support setting the frequency
+                pass
+
+        logging.debug("Learning RF Frequency, press and hold the button to learn...")
+        self.device.sweep_frequency()
+        self.phase = 'sweep'
+        self.interval = cf.get('learning_interval', 0.2)
+        self.expire_at(time.monotonic() + cf.get('learning_rf_sweep_timeout', 20))
+        self.publish('sweeping')
+        self.schedule()
+
+    def capture(self):
+        self.phase = 'capture'
+        self.interval = cf.get('learning_interval', 0.2)
+        self.expire_at(time.monotonic() + cf.get('learning_timeout', 40))
+        self.publish('learning')
+        self.schedule()
+
+    def expire_at(self, deadline):
+        """Sets deadline of the current phase, it's also enforced by the scheduler in case steps are not executed,
+        e.g. when the device is unavailable or a step is dropped from the full queue"""
+        self.deadline = deadline
+        scheduler.call_later(deadline - time.monotonic() + cf.get('learning_interval_max', 1),
+                             self.expire, self.phase, deadline)
+
+    def expire(self, phase, deadline):
+        if not self.finished and self.phase == phase and self.deadline == deadline:
+            logging.warning("Learning of command %s was not completed in time" % self.command)
+            self.finish('timeout')
+
+    def schedule(self, delay=None):
+        scheduler.call_later(self.interval if delay is None else delay, self.submit_step)
+        self.interval = min(self.interval * 1.5, cf.get('learning_interval_max', 1))
+
+    def submit_step(self):
+        if not self.finished and not self.device.worker.submit(self.run_step):
+            self.finish('failed')
+
+    def run_step(self):
+        try:
+            self.device.session.run(self.step)
+        except Exception:
+            # communication errors are retried by the session, so the step has failed for good
+            self.finish('failed')
+            raise
+
+    def step(self):
+        if self.finished:
+            return
+        if self.phase == 'sweep':
+            self.sweep_step()
+        elif self.phase == 'found':
+            logging.debug("To complete learning, single press the button you want to learn")
+            self.device.find_rf_packet()
+            self.capture()
+        else:
+            self.capture_step()
+
+    def sweep_step(self):
+        result = self.device.check_frequency()
+        # broadlink library 0.16+ returns frequency together with the flag
+        found, frequency = result if isinstance(result, tuple) else (result, None)
+        if found:
+            logging.debug("Found RF Frequency %s - 1 of 2!" % frequency)
+            if frequency is not None:
+                rf_frequencies.put(self.remote, frequency)
+            self.phase = 'found'
+            # give time to release the button
+            self.expire_at(time.monotonic() + cf.get('learning_rf_pause', 5))
+            self.schedule(cf.get('learning_rf_pause', 5))
+        elif time.monotonic() >= self.deadline:
+            logging.warning("RF Frequency not found")
+            self.device.cancel_sweep_frequency()
+            self.finish('timeout')
+        else:
+            self.schedule()
+
+    def capture_step(self):
+        try:
+            packet = self.device.check_data()
+        except (broadlink.exceptions.ReadError, broadlink.exceptions.StorageError):
+            packet = None
+        if packet is not None:
+            command_cache.save(self.file, packet)
+            logging.debug("Done")
+            self.finish('done')
+        elif time.monotonic() >= self.deadline:
+            logging.warning("No command received")
+            self.finish('timeout')
+        else:
+            self.schedule()
+
+    def cancel(self):
+        if not self.finished:
+            logging.debug("Learning of command %s is cancelled" % self.command)
+            if self.phase in ('sweep', 'found'):
+                self.device.cancel_sweep_frequency()
+            self.finish('cancelled')
+
+    def finish(self, state):
+        if self.finished:
+            return
+        self.finished = True
+        if state == 'timeout' and self.stored_frequency:
+            # remembered frequency may be wrong, so the next learning sweeps it again
+            logging.debug("Forgetting RF frequency of %s" % self.remote)
+            rf_frequencies.remove(self.remote)
+        if self.device.learning is self:
+            self.device.learning = None
+        self.publish(state)
+
+    def publish(self, state):
+        publisher.publish(self.device.mqtt_prefix + 'learning',
+                          json.dumps({'command': self.command, 'state': state,
+                                      'elapsed': round(time.monotonic() - self.started, 3)}),
+                          qos=settings.qos, retain=False)
+
+
+class DeviceWorker(Thread):
+    """Executes commands of a single device one by one in the order they were received, priority commands go ahead
+    of other ones and are executed between steps of a long command being executed"""
+
+    def __init__(self, device, size, overflow):
+        Thread.__init__(self)
+        self.daemon = True
+        self.device = device
+        self.size = size
+        self.overflow = overflow
+        self.queues = (collections.deque(), collections.deque())  # priority and normal lanes
+        self.condition = Condition()
+        self.stopped = False
+        self.cancelled = False
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            for queue in self.queues:
+                queue.clear()
+            self.condition.notify_all()
+
+    def cancel(self):
+        """Stops the command being executed at its next step"""
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+
+    def submit(self, func, *args):
+        """Queues internal job, e.g. a step of learning, it's submitted by the scheduler thread, so it never blocks"""
+        return self.enqueue(self.queues[1], func, args, 'drop_new')
+
+    def submit_command(self, command, action):
+        queue = self.queues[0 if is_command_in(PRIORITY_COMMANDS.get(self.device.type, ()), command, action) else 1]
+        return self.enqueue(queue, self.execute_command, (command, action))
+
+    def enqueue(self, queue, func, args, overflow=None):
+        overflow = overflow or self.overflow
+        with self.condition:
+            if self.stopped:
+                return False
+            if 0 < self.size <= len(queue):
+                if overflow == 'drop_new':
+                    logging.warning("Command queue of device %s is full, dropping new command" % self.device.type)
+                    return False
+                elif overflow == 'drop_oldest':
+                    logging.warning("Command queue of device %s is full, dropping oldest command" % self.device.type)
+                    queue.popleft()
+                else:  # block
+                    while len(queue) >= self.size:
+                        self.condition.wait()
+            queue.append((func, args, time.monotonic()))
+            self.condition.notify_all()
+        return True
+
+    def take(self, queue):
+        job = queue.popleft()
+        self.condition.notify_all()
+        metrics.set('broadlink_mqtt_queue_depth', len(self.queues[0]) + len(self.queues[1]),
+                    device=device_id(self.device))
+        return job
+
+    def pause(self, seconds):
+        """Waits given number of seconds executing priority commands received meanwhile,
+        returns True if the command being executed is cancelled"""
+        deadline = time.monotonic() + seconds
+        while True:
+            with self.condition:
+                while not self.cancelled and not self.stopped and not self.queues[0]:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+                if self.cancelled or self.stopped:
+                    return True
+                job = self.take(self.queues[0])
+            self.execute(job)
+
+    def take_repeats(self, command, action, window):
+        """Removes the same command received again within window seconds after the first press from the queue,
+        returns number of removed commands"""
+        count = 0
+        deadline = time.monotonic() + window
+        queue = self.queues[1]
+        with self.condition:
+            while not self.cancelled and not self.stopped and not self.queues[0]:
+                if queue:
+                    if queue[0][:2] != (self.execute_command, (command, action)):
+                        break
+                    self.take(queue)
+                    count += 1
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+        return count
+
+    def execute_command(self, command, action):
+        window = settings.coalesce_window
+        file = replay_file(self.device, command, action) if window > 0 else None
+        if file is None:
+            self.device.session.run(dispatch_command, self.device, command, action)
+            return
+        count = 1 + self.take_repeats(command, action, window)
+        coalesced(self.device, count)
+        self.device.session.run(replay, self.device, file, count)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queues[0] and not self.queues[1] and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                job = self.take(self.queues[0] if self.queues[0] else self.queues[1])
+                self.cancelled = False
+            self.execute(job)
+
+    def execute(self, job):
+        func, args, submitted = job
+        metrics.observe('broadlink_mqtt_queue_wait_seconds', time.monotonic() - submitted,
+                        device=device_id(self.device))
+        try:
+            func(*args)
+        except DeviceUnavailableError as e:
+            logging.warning(str(e))
+            self.device.session.report(e)
+        except Exception as e:
+            logging.exception("Error")
+            self.device.session.report(e)
 
-    try:
-        is_json = cf.get('broadlink_bg1_state_json', False)
-        state = device.get_state()
-        if is_json:
-            topic = mqtt_prefix + "state"
-            value = json.dumps(state)
-            logging.debug("Sending BG1 state '%s' to topic '%s'" % (value, topic))
-            mqttc.publish(topic, value, qos=qos, retain=retain)
-        elif state is not None:
-            for name in state:
-                topic = mqtt_prefix + "state/" + name
-                value = str(state[name])
-                logging.debug("Sending BG1 %s '%s' to topic '%s'" % (name, value, topic))
-                mqttc.publish(topic, value, qos=qos, retain=retain)
-    except:
-        logging.exception("Error")
 
+class PollScheduler(Thread):
+    """Plans periodic polls of all devices from a single thread and runs them on a bounded pool of workers,
+    also runs short delayed calls"""
 
-class SchedulerThread(Thread):
-    def __init__(self, scheduler):
+    def __init__(self, jitter, workers, timeout):
         Thread.__init__(self)
-        self.scheduler = scheduler
+        self.daemon = True
+        self.jitter = jitter
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.queue = []  # heap of [due time, sequence, interval, func, args]
+        self.sequence = itertools.count()
+        self.condition = Condition()
+        self.running = {}  # device -> start time of its poll being executed
+
+    def add(self, interval, func, device, *args):
+        args = (device,) + args
+        # spread first runs of polls having the same interval to avoid bursts
+        delay = random.uniform(0, interval) if self.jitter else interval
+        with self.condition:
+            heapq.heappush(self.queue, [time.monotonic() + delay, next(self.sequence), interval, func, args])
+            self.condition.notify()
+
+    def call_later(self, delay, func, *args):
+        """Calls func once after delay seconds, func is called by scheduler thread so it should be short"""
+        with self.condition:
+            heapq.heappush(self.queue, [time.monotonic() + delay, next(self.sequence), None, func, args])
+            self.condition.notify()
+
+    def remove(self, device):
+        with self.condition:
+            self.queue = [entry for entry in self.queue if not entry[4] or entry[4][0] is not device]
+            heapq.heapify(self.queue)
 
     def run(self):
+        while True:
+            with self.condition:
+                now = time.monotonic()
+                if not self.queue or self.queue[0][0] > now:
+                    self.condition.wait(self.queue[0][0] - now if self.queue else None)
+                    continue
+                entry = heapq.heappop(self.queue)
+                due, interval, func, args = entry[0], entry[2], entry[3], entry[4]
+                device = self.plan(entry, now) if interval is not None else None
+
+            if interval is None:
+                try:
+                    func(*args)
+                except Exception:
+                    logging.exception("Error")
+            elif device is not None:
+                logging.debug("Poll %s started %d ms late" % (func.__name__, (now - due) * 1000))
+                metrics.observe('broadlink_mqtt_poll_lateness_seconds', now - due, poll=func.__name__)
+                self.executor.submit(self.poll, device, func, args)
+
+    def plan(self, entry, now):
+        """Plans next run of the poll and returns device to poll now or None if this run should be skipped"""
+        due, interval, func, args = entry[0], entry[2], entry[3], entry[4]
+        # next run is calculated from the planned time, not from the actual one, so polls don't drift
+        entry[0] = due + interval
+        if entry[0] <= now:
+            skipped = int((now - due) // interval)
+            logging.warning("Poll %s is %d periods behind schedule, skipping them" % (func.__name__, skipped))
+            entry[0] += skipped * interval
+        entry[1] = next(self.sequence)
+        heapq.heappush(self.queue, entry)
+
+        device = args[0]
+        if not device.session.ready():
+            logging.debug("Device of poll %s is unavailable, skipping" % func.__name__)
+            return None
+        started = self.running.get(device)
+        if started is not None:
+            if now - started > self.timeout:
+                logging.warning("Poll %s is running for %d seconds exceeding timeout, skipping" %
+                                (func.__name__, now - started))
+            else:
+                logging.debug("Previous poll of %s is still running, skipping" % func.__name__)
+            return None
+        self.running[device] = now
+        return device
+
+    def poll(self, device, func, args):
+        start = time.monotonic()
         try:
-            self.scheduler.run()
-        except:
+            device.session.run(func, *args)
+        except DeviceUnavailableError as e:
+            metrics.inc('broadlink_mqtt_poll_failures_total', poll=func.__name__)
+            logging.warning(str(e))
+        except Exception:
+            metrics.inc('broadlink_mqtt_poll_failures_total', poll=func.__name__)
             logging.exception("Error")
+        finally:
+            metrics.observe('broadlink_mqtt_poll_seconds', time.monotonic() - start, poll=func.__name__)
+            with self.condition:
+                del self.running[device]
 
 
-if __name__ == '__main__':
-    devices = get_device(cf)
+class AsyncScheduler(object):
+    """Asyncio counterpart of PollScheduler: every poll is a coroutine sleeping on the event loop until its next run,
+    blocking calls of devices are executed by a bounded pool of threads shared with device workers"""
+
+    def __init__(self, loop, jitter, workers, poll_workers, timeout):
+        self.loop = loop
+        self.jitter = jitter
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.polls = asyncio.Semaphore(poll_workers)
+        self.tasks = collections.defaultdict(list)  # device -> tasks of its polls
+        self.running = {}  # device -> start time of its poll being executed
+
+    def add(self, interval, func, device, *args):
+        self.loop.call_soon_threadsafe(self.start_poll, interval, func, device, (device,) + args)
+
+    def start_poll(self, interval, func, device, args):
+        self.tasks[device].append(self.loop.create_task(self.poll_loop(interval, func, device, args)))
 
+    def call_later(self, delay, func, *args):
+        """Calls func once after delay seconds, func is called in event loop thread so it should be short"""
+        self.loop.call_soon_threadsafe(self.loop.call_later, delay, self.call, func, args)
+
+    # noinspection PyMethodMayBeStatic
+    def call(self, func, args):
+        try:
+            func(*args)
+        except Exception:
+            logging.exception("Error")
+
+    def remove(self, device):
+        self.loop.call_soon_threadsafe(self.cancel_polls, device)
+
+    def cancel_polls(self, device):
+        for task in self.tasks.pop(device, []):
+            task.cancel()
+
+    async def poll_loop(self, interval, func, device, args):
+        # spread first runs of polls having the same interval to avoid bursts
+        due = self.loop.time() + (random.uniform(0, interval) if self.jitter else interval)
+        while True:
+            await asyncio.sleep(due - self.loop.time())
+            now = self.loop.time()
+            if self.ready(device, func, now):
+                logging.debug("Poll %s started %d ms late" % (func.__name__, (now - due) * 1000))
+                metrics.observe('broadlink_mqtt_poll_lateness_seconds', now - due, poll=func.__name__)
+                self.running[device] = now
+                # poll is not awaited, so its duration doesn't shift the next run
+                self.loop.create_task(self.poll(device, func, args))
+            # next run is calculated from the planned time, not from the actual one, so polls don't drift
+            next_due = due + interval
+            if next_due <= now:
+                skipped = int((now - due) // interval)
+                logging.warning("Poll %s is %d periods behind schedule, skipping them" % (func.__name__, skipped))
+                next_due += skipped * interval
+            due = next_due
+
+    def ready(self, device, func, now):
+        if not device.session.ready():
+            logging.debug("Device of poll %s is unavailable, skipping" % func.__name__)
+            return False
+        started = self.running.get(device)
+        if started is not None:
+            if now - started > self.timeout:
+                logging.warning("Poll %s is running for %d seconds exceeding timeout, skipping" %
+                                (func.__name__, now - started))
+            else:
+                logging.debug("Previous poll of %s is still running, skipping" % func.__name__)
+            return False
+        return True
+
+    async def poll(self, device, func, args):
+        start = time.monotonic()
+        try:
+            async with self.polls:
+                await self.loop.run_in_executor(self.executor, device.session.run, func, *args)
+        except DeviceUnavailableError as e:
+            metrics.inc('broadlink_mqtt_poll_failures_total', poll=func.__name__)
+            logging.warning(str(e))
+        except Exception:
+            metrics.inc('broadlink_mqtt_poll_failures_total', poll=func.__name__)
+            logging.exception("Error")
+        finally:
+            metrics.observe('broadlink_mqtt_poll_seconds', time.monotonic() - start, poll=func.__name__)
+            del self.running[device]
+
+
+class AsyncDeviceWorker(object):
+    """Asyncio counterpart of DeviceWorker: commands of a device are executed one by one by a coroutine,
+    blocking calls run in the pool of threads of the scheduler and pauses of macros are awaited on the event loop,
+    so the command being executed can be cancelled at any moment"""
+
+    def __init__(self, device, size, overflow):
+        self.device = device
+        self.size = size
+        self.overflow = overflow
+        self.loop = scheduler.loop
+        self.executor = scheduler.executor
+        self.queues = (collections.deque(), collections.deque())  # priority and normal lanes
+        self.wakeup = None
+        self.preempt = None  # set when priority command is received
+        self.cancelled = Event()  # checked by blocking commands running in the pool of threads
+        self.calls = set()  # blocking calls of the command being executed, they go on when its task is cancelled
+        self.task = None
+        self.current = None
+        self.stopped = False
+
+    def start(self):
+        self.loop.call_soon_threadsafe(self.begin)
+
+    def begin(self):
+        self.wakeup = asyncio.Event()
+        self.preempt = asyncio.Event()
+        self.task = self.loop.create_task(self.run())
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.halt)
+
+    def halt(self):
+        self.stopped = True
+        self.cancelled.set()
+        for queue in self.queues:
+            queue.clear()
+        if self.task is not None:
+            self.task.cancel()
+
+    def cancel(self):
+        """Cancels the command being executed, commands waiting in the queue are executed as usual"""
+        self.cancelled.set()
+        self.loop.call_soon_threadsafe(self.interrupt)
+
+    def interrupt(self):
+        if self.current is not None:
+            self.current.cancel()
+
+    def pause(self, seconds):
+        """Called by blocking commands, returns True if the command being executed is cancelled"""
+        return self.cancelled.wait(seconds)
+
+    def submit(self, func, *args):
+        self.loop.call_soon_threadsafe(self.enqueue, self.queues[1], self.call, (func,) + args)
+        return True
+
+    def submit_command(self, command, action):
+        queue = self.queues[0 if is_command_in(PRIORITY_COMMANDS.get(self.device.type, ()), command, action) else 1]
+        self.loop.call_soon_threadsafe(self.enqueue, queue, self.execute_command, (command, action))
+        return True
+
+    def enqueue(self, queue, coroutine, args):
+        if self.stopped:
+            return
+        if 0 < self.size <= len(queue):
+            if self.overflow == 'drop_oldest':
+                logging.warning("Command queue of device %s is full, dropping oldest command" % self.device.type)
+                queue.popleft()
+            else:
+                # event loop cannot be blocked, so 'block' drops new commands as well
+                logging.warning("Command queue of device %s is full, dropping new command" % self.device.type)
+                return
+        queue.append((coroutine, args, time.monotonic()))
+        self.wakeup.set()
+        if queue is self.queues[0]:
+            self.preempt.set()
+
+    def take(self, queue):
+        coroutine, args, submitted = queue.popleft()
+        metrics.set('broadlink_mqtt_queue_depth', len(self.queues[0]) + len(self.queues[1]),
+                    device=device_id(self.device))
+        metrics.observe('broadlink_mqtt_queue_wait_seconds', time.monotonic() - submitted,
+                        device=device_id(self.device))
+        return coroutine, args
+
+    async def run(self):
+        while True:
+            while not self.queues[0] and not self.queues[1]:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            coroutine, args = self.take(self.queues[0] if self.queues[0] else self.queues[1])
+            self.cancelled.clear()
+            self.current = self.loop.create_task(self.execute(coroutine, args))
+            try:
+                await self.current
+            except asyncio.CancelledError:
+                if self.stopped:
+                    raise
+                logging.debug("Command of device %s is cancelled" % self.device.type)
+                # blocking call of the cancelled command stops at its next pause only while the flag is set
+                await self.settle()
+            finally:
+                self.current = None
+
+    async def execute(self, coroutine, args):
+        try:
+            await coroutine(*args)
+        except DeviceUnavailableError as e:
+            logging.warning(str(e))
+            self.device.session.report(e)
+        except Exception as e:
+            logging.exception("Error")
+            self.device.session.report(e)
+
+    async def run_priority(self, seconds):
+        """Waits given number of seconds executing priority commands received meanwhile"""
+        deadline = self.loop.time() + seconds
+        while True:
+            while self.queues[0]:
+                await self.execute(*self.take(self.queues[0]))
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                return
+            self.preempt.clear()
+            try:
+                await asyncio.wait_for(self.preempt.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def call(self, func, *args):
+        future = self.executor.submit(func, *args)
+        self.calls.add(future)
+        try:
+            return await asyncio.wrap_future(future)
+        finally:
+            if future.done():
+                self.calls.discard(future)
+
+    async def settle(self):
+        """Waits until blocking calls of the cancelled command return"""
+        while self.calls:
+            future = self.calls.pop()
+            if not future.done():
+                await asyncio.wait([asyncio.wrap_future(future)])
+
+    async def take_repeats(self, command, action, window):
+        """Removes the same command received again within window seconds after the first press from the queue,
+        returns number of removed commands"""
+        count = 0
+        deadline = self.loop.time() + window
+        queue = self.queues[1]
+        while not self.cancelled.is_set() and not self.queues[0]:
+            if queue:
+                if queue[0][:2] != (self.execute_command, (command, action)):
+                    break
+                self.take(queue)
+                count += 1
+                continue
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                break
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        return count
+
+    async def execute_command(self, command, action):
+        window = settings.coalesce_window
+        file = await self.call(replay_file, self.device, command, action) if window > 0 else None
+        if file is not None:
+            count = 1 + await self.take_repeats(command, action, window)
+            coalesced(self.device, count)
+            await self.call(self.device.session.run, replay, self.device, file, count)
+            return
+        plan = await self.call(command_plan, self.device, command, action)
+        if plan is None:
+            await self.call(self.device.session.run, dispatch_command, self.device, command, action)
+            return
+        for step, value in plan:
+            if step == 'pause':
+                logging.debug("Pause for " + str(int(value * 1000)) + " milliseconds")
+            # priority commands received meanwhile are executed between steps
+            await self.run_priority(value if step == 'pause' else 0)
+            if step == 'send':
+                await self.call(self.device.session.run, send_data, self.device, value)
+
+
+class AsyncNetwork(object):
+    """Drives network loop of MQTT client from asyncio event loop instead of loop_forever,
+    socket callbacks may be called by other threads publishing messages, so they are passed to the event loop"""
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.thread = get_ident()
+        self.misc = None
+        self.closed = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def call(self, func, *args):
+        if get_ident() == self.thread:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    # noinspection PyUnusedLocal
+    def on_socket_open(self, client, userdata, sock):
+        self.call(self.opened, sock)
+
+    # noinspection PyUnusedLocal
+    def on_socket_close(self, client, userdata, sock):
+        self.call(self.close, sock)
+
+    # noinspection PyUnusedLocal
+    def on_socket_register_write(self, client, userdata, sock):
+        self.call(self.loop.add_writer, sock, self.client.loop_write)
+
+    # noinspection PyUnusedLocal
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.call(self.loop.remove_writer, sock)
+
+    def opened(self, sock):
+        self.loop.add_reader(sock, self.client.loop_read)
+        self.misc = self.loop.create_task(self.misc_loop())
+
+    def close(self, sock):
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+        if self.misc is not None:
+            self.misc.cancel()
+            self.misc = None
+        if self.closed is not None and not self.closed.done():
+            self.closed.set_result(True)
+
+    async def misc_loop(self):
+        # keep alive pings and retries of messages
+        while self.client.loop_misc() == paho.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    async def run(self):
+        reconnect_delay = cf.get('mqtt_reconnect_delay', 1)
+        delay = reconnect_delay
+        while True:
+            self.closed = self.loop.create_future()
+            try:
+                # name lookup and TCP connect block, so they don't run on the event loop
+                await self.loop.run_in_executor(scheduler.executor, connect, self.client)
+                delay = reconnect_delay
+                await self.closed
+                logging.debug("Reconnecting to MQTT server in %g seconds" % delay)
+            except socket.error:
+                logging.warning("Cannot connect to MQTT server, will try to reconnect in %g seconds" % delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, cf.get('mqtt_reconnect_delay_max', 120))
+
+
+async def repeat_async(interval, immediate, func, *args):
+    """Asyncio counterpart of metrics_loop and lookup_loop, func is executed by the pool of threads of the scheduler"""
+    if not immediate:
+        await asyncio.sleep(interval)
+    while True:
+        try:
+            await scheduler.loop.run_in_executor(scheduler.executor, func, *args)
+        except Exception:
+            logging.exception("Error")
+        if interval <= 0:
+            return
+        await asyncio.sleep(interval)
+
+
+async def run_asyncio():
+    """Runs the bridge on asyncio event loop: MQTT network I/O, polls, pauses of macros and learning waits are
+    coroutines, blocking calls of devices are executed by a bounded pool of threads"""
+    global scheduler, mqttc
+    loop = asyncio.get_running_loop()
+    scheduler = AsyncScheduler(loop, cf.get('broadlink_poll_jitter', True),
+                               cf.get('asyncio_workers', 8),
+                               cf.get('broadlink_poll_workers', 4),
+                               cf.get('broadlink_poll_timeout', 10))
+
+    devices = await loop.run_in_executor(scheduler.executor, get_device, cf)
+    router = TopicRouter(devices)
+    mqttc = create_client(router)
+    network = AsyncNetwork(loop, mqttc)
+    publisher.loop = loop
+    if hasattr(signal, 'SIGHUP'):
+        loop.add_signal_handler(signal.SIGHUP, start_reload, router)
+
+    if metrics_topic is not None:
+        loop.create_task(repeat_async(cf.get('metrics_interval', 60), False, publish_metrics, metrics_topic))
+    start_metrics_server()
+    lookup = background_lookup(router)
+    if lookup is not None:
+        loop.create_task(repeat_async(lookup[0], lookup[1], update_devices, cf, router))
+
+    await network.run()
+
+
+def create_client(router):
     clientid = cf.get('mqtt_clientid', 'broadlink-%s' % os.getpid())
+    if shard is not None:
+        # every worker process has its own MQTT session
+        clientid += '-shard' + shard
     # initialise MQTT broker connection
-    mqttc = paho.Client(paho.CallbackAPIVersion.VERSION1, clientid, clean_session=cf.get('mqtt_clean_session', False), userdata=devices)
+    # clean session flag is not supported by MQTT v5 protocol
+    clean_session = None if mqtt_protocol == paho.MQTTv5 else cf.get('mqtt_clean_session', False)
+    client = paho.Client(paho.CallbackAPIVersion.VERSION1, clientid, clean_session=clean_session, userdata=router,
+                         protocol=mqtt_protocol)
 
-    mqttc.on_message = on_message
-    mqttc.on_connect = on_connect
-    mqttc.on_disconnect = on_disconnect
+    client.on_message = on_message
+    client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
 
     if cf.get('mqtt_will_payload', False):
-        mqttc.will_set(cf.get('mqtt_will_topic', 'clients/broadlink'), payload=cf.get('mqtt_will_payload'), qos=0, retain=True)
+        client.will_set(cf.get('mqtt_will_topic', 'clients/broadlink'), payload=cf.get('mqtt_will_payload'), qos=0, retain=True)
 
-    # Delays will be: 3, 6, 12, 24, 30, 30, ...
-    # mqttc.reconnect_delay_set(delay=3, delay_max=30, exponential_backoff=True)
+    # delay before reconnection is doubled after every failed attempt
+    client.reconnect_delay_set(min_delay=cf.get('mqtt_reconnect_delay', 1),
+                               max_delay=cf.get('mqtt_reconnect_delay_max', 120))
 
     if cf.get('tls', False):
-        mqttc.tls_set(cf.get('ca_certs', None), cf.get('certfile', None), cf.get('keyfile', None),
-                      tls_version=cf.get('tls_version', None), ciphers=None)
+        client.tls_set(cf.get('ca_certs', None), cf.get('certfile', None), cf.get('keyfile', None),
+                       tls_version=cf.get('tls_version', None), ciphers=None)
 
     if cf.get('tls_insecure', False):
-        mqttc.tls_insecure_set(True)
+        client.tls_insecure_set(True)
+
+    client.username_pw_set(cf.get('mqtt_username'), cf.get('mqtt_password'))
+    return client
+
+
+def connect(client):
+    client.connect(cf.get('mqtt_broker', 'localhost'),
+                   port=int(cf.get('mqtt_port', '1883')),
+                   keepalive=60,
+                   bind_address=cf.get('mqtt_bind', ''))
+
+
+def start_metrics_server():
+    metrics_port = cf.get('metrics_port', None)
+    if metrics_port is not None:
+        if shard is not None:
+            # worker processes serve metrics on consecutive ports
+            metrics_port += int(shard)
+        metrics_server = MetricsServer((cf.get('metrics_bind', ''), metrics_port), MetricsHandler)
+        metrics_thread = Thread(target=metrics_server.serve_forever)
+        metrics_thread.daemon = True
+        metrics_thread.start()
+
+
+def background_lookup(router):
+    """Returns interval of lookups in background and whether the first one should be done right away,
+    or None if background lookup is not needed"""
+    if shard is not None:
+        # devices of worker processes are looked up by the supervisor
+        return None
+    lookup_interval = cf.get('lookup_interval', 0)
+    cached = any(getattr(device, 'cached', False) for device in router.devices())
+    if cf.get('device_type', 'lookup') in ('lookup', 'multiple_lookup') and (lookup_interval > 0 or cached):
+        # devices taken from the lookup cache file are checked by lookup in background right away
+        return lookup_interval, cached
+    return None
+
+
+class Supervisor(object):
+    """Splits devices between worker processes by hash of MAC address or explicit mapping, every worker runs
+    the bridge for its own devices with its own MQTT client. Crashed workers are restarted after growing delay,
+    devices of a worker crashing too often are moved to other workers"""
+
+    def __init__(self, workers, mapping, delay, max_restarts, window):
+        self.workers = workers
+        self.mapping = dict((mac.lower().replace('-', ':'), index % workers) for mac, index in mapping.items())
+        self.delay = delay
+        self.max_restarts = max_restarts
+        self.window = window
+        self.directory = tempfile.mkdtemp(prefix='broadlink-shards-')
+        self.devices = {}  # MAC -> device
+        self.shards = [None] * workers  # devices given to every worker
+        self.processes = [None] * workers
+        self.crashes = [[] for index in range(workers)]  # times of recent crashes of every worker
+        self.restarts = {}  # worker index -> time of planned restart
+        self.failed = set()  # workers crashing too often
+
+    def shard_of(self, device):
+        mac = ':'.join(format(s, '02x') for s in device.mac)
+        index = self.mapping.get(mac)
+        if index is None:
+            # CRC is stable between runs unlike hash() of Python
+            index = zlib.crc32(bytes(device.mac)) % self.workers
+        if index in self.failed:
+            alive = [i for i in range(self.workers) if i not in self.failed]
+            index = alive[zlib.crc32(bytes(device.mac)) % len(alive)]
+        return index
+
+    def add_devices(self, devices):
+        for device in devices:
+            self.devices[':'.join(format(s, '02x') for s in device.mac)] = device
+        self.distribute()
+
+    def distribute(self):
+        """Gives devices to workers and restarts workers whose devices changed"""
+        shards = [[] for index in range(self.workers)]
+        for mac in sorted(self.devices):
+            shards[self.shard_of(self.devices[mac])].append(self.devices[mac])
+        for index, devices in enumerate(shards):
+            key = [(device.mac, device.host) for device in devices]
+            if key == self.shards[index]:
+                continue
+            self.shards[index] = key
+            self.stop(index)
+            if devices:
+                logging.debug("Worker %d handles %d devices" % (index, len(devices)))
+                save_devices(self.shard_file(index), devices)
+                self.start(index)
+
+    def shard_file(self, index):
+        return os.path.join(self.directory, 'shard%d.json' % index)
+
+    def start(self, index):
+        self.restarts.pop(index, None)
+        env = dict(os.environ, BROADLINKMQTTSHARD=str(index), BROADLINKMQTTSHARDFILE=self.shard_file(index))
+        self.processes[index] = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+
+    def stop(self, index):
+        self.restarts.pop(index, None)
+        process = self.processes[index]
+        self.processes[index] = None
+        if process is None or process.poll() is not None:
+            return
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+    def check(self):
+        now = time.monotonic()
+        for index, process in enumerate(self.processes):
+            if process is not None and process.poll() is not None:
+                self.processes[index] = None
+                self.crashed(index, process.returncode, now)
+        for index, restart_time in list(self.restarts.items()):
+            if now >= restart_time:
+                logging.debug("Restarting worker %d" % index)
+                self.start(index)
+
+    def crashed(self, index, returncode, now):
+        crashes = [t for t in self.crashes[index] if now - t < self.window] + [now]
+        self.crashes[index] = crashes
+        if len(crashes) > self.max_restarts and len(self.failed) + 1 < self.workers:
+            logging.error("Worker %d exited with code %s %d times in %d seconds, moving its devices to other workers" %
+                          (index, returncode, len(crashes), self.window))
+            self.failed.add(index)
+            self.distribute()
+            return
+        delay = min(self.delay * 2 ** (len(crashes) - 1), 60)
+        logging.warning("Worker %d exited with code %s, restarting in %g seconds" % (index, returncode, delay))
+        self.restarts[index] = now + delay
+
+    def run(self, cf):
+        self.add_devices(lookup_devices(cf))
+        lookup_interval = cf.get('lookup_interval', 0)
+        lookup_time = time.monotonic() + lookup_interval
+        while True:
+            time.sleep(1)
+            self.check()
+            if 0 < lookup_interval and lookup_time <= time.monotonic():
+                lookup_time = time.monotonic() + lookup_interval
+                try:
+                    # new and moved devices are added, missing ones stay with their workers reporting them unavailable
+                    self.add_devices(discover_devices(cf))
+                except Exception:
+                    logging.exception("Error")
+
+    def reload(self):
+        for process in self.processes:
+            if process is not None and process.poll() is None:
+                process.send_signal(signal.SIGHUP)
+
+    def shutdown(self):
+        for index in range(self.workers):
+            self.stop(index)
+        shutil.rmtree(self.directory, ignore_errors=True)
 
-    mqttc.username_pw_set(cf.get('mqtt_username'), cf.get('mqtt_password'))
 
+if __name__ == '__main__':
+    shard_workers = cf.get('shard_workers', 0)
+    if shard_workers > 0 and shard is None:
+        if cf.get('device_type', 'lookup') != 'multiple_lookup':
+            logging.error('Splitting devices between worker processes requires multiple_lookup device type')
+            sys.exit(2)
+        # terminate workers when the supervisor is stopped
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        supervisor = Supervisor(shard_workers, cf.get('shard_mapping', {}), cf.get('shard_restart_delay', 1),
+                                cf.get('shard_max_restarts', 5), cf.get('shard_restart_window', 300))
+        if hasattr(signal, 'SIGHUP'):
+            # workers reload their configuration
+            signal.signal(signal.SIGHUP, lambda signum, frame: supervisor.reload())
+        try:
+            supervisor.run(cf)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            supervisor.shutdown()
+        sys.exit(0)
+
+    if cf.get('command_cache_preload', False):
+        command_cache.preload(dirname + "commands/")
+
+    if runtime == 'asyncio':
+        try:
+            asyncio.run(run_asyncio())
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    scheduler = PollScheduler(cf.get('broadlink_poll_jitter', True),
+                              cf.get('broadlink_poll_workers', 4),
+                              cf.get('broadlink_poll_timeout', 10))
+    scheduler.start()
+
+    devices = get_device(cf)
+    router = TopicRouter(devices)
+    mqttc = create_client(router)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: start_reload(router))
+    publisher.start()
+
+    if metrics_topic is not None:
+        metrics_thread = Thread(target=metrics_loop, args=(metrics_topic, cf.get('metrics_interval', 60)))
+        metrics_thread.daemon = True
+        metrics_thread.start()
+    start_metrics_server()
+
+    lookup = background_lookup(router)
+    if lookup is not None:
+        lookup_thread = Thread(target=lookup_loop, args=(cf, router) + lookup)
+        lookup_thread.daemon = True
+        lookup_thread.start()
+
+    reconnect_delay = cf.get('mqtt_reconnect_delay', 1)
+    delay = reconnect_delay
     while True:
         try:
-            mqttc.connect(cf.get('mqtt_broker', 'localhost'),
-                          port=int(cf.get('mqtt_port', '1883')),
-                          keepalive=60,
-                          bind_address=cf.get('mqtt_bind', ''))
+            connect(mqttc)
+            delay = reconnect_delay
             mqttc.loop_forever()
         except socket.error:
-            logging.warning("Cannot connect to MQTT server, will try to reconnect in 5 seconds")
-            time.sleep(5)
+            logging.warning("Cannot connect to MQTT server, will try to reconnect in %g seconds" % delay)
+            time.sleep(delay)
+            delay = min(delay * 2, cf.get('mqtt_reconnect_delay_max', 120))
         except KeyboardInterrupt:
             sys.exit(0)
         except: